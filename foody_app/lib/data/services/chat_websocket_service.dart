@@ -3,6 +3,8 @@ import 'dart:async';
 import 'dart:convert';
 import 'package:web_socket_channel/web_socket_channel.dart';
 import 'package:web_socket_channel/status.dart' as status;
+import 'package:shared_preferences/shared_preferences.dart';
+import 'package:foody_app/core/constants/app_constants.dart';
 
 class ChatWebSocketService {
   WebSocketChannel? _channel;
@@ -24,7 +26,13 @@ class ChatWebSocketService {
 
     try {
       print('Connecting to WebSocket: $wsUrl'); // Delete on prod
-      _channel = WebSocketChannel.connect(Uri.parse(wsUrl));
+      // The chat server only accepts connections carrying the API token
+      final prefs = await SharedPreferences.getInstance();
+      final token = prefs.getString(AppConstants.tokenKey);
+      final uri = Uri.parse(wsUrl);
+      _channel = WebSocketChannel.connect(token == null
+          ? uri
+          : uri.replace(queryParameters: {...uri.queryParameters, 'token': token}));
 
       _channel!.stream.listen(
             (message) {
@@ -102,6 +102,15 @@ class ChatConversationProvider extends ChangeNotifier {
           }
           break;
 
+        case 'presence_batch':
+          for (final change in data['changes'] as List) {
+            if (change['dialogueId'] == dialogueId) {
+              _isOnline = change['isOnline'] == true;
+              notifyListeners();
+            }
+          }
+          break;
+
         case 'typing':
         // Handle typing indicator if needed
           break;
@@ -76,6 +76,12 @@ class ChatListProvider extends ChangeNotifier {
           _updateOnlineStatus(data['dialogueId'], false);
           break;
 
+        case 'presence_batch':
+          for (final change in data['changes'] as List) {
+            _updateOnlineStatus(change['dialogueId'], change['isOnline'] == true);
+          }
+          break;
+
         case 'mark_read_success':
           _markAsReadSuccess(data['dialogueId']);
           break;
@@ -0,0 +1,286 @@
+# bench_fanout.py
+# Start the chat server, connect N clients and measure how fast send_message
+# fans out to all of them.
+#
+#   python bench_fanout.py --clients 1000 --rate 20 --duration 10
+#   python bench_fanout.py --clients 10000 --workers 4 --json fanout.json
+#
+# Reports new_message delivery latency percentiles (send to receipt at each
+# client), broadcast duration (send to receipt at the last client), server CPU,
+# server memory per connection and server event loop lag (from /stats).
+# Clients run in this process, so past a few thousand connections the client
+# side can become the bottleneck; compare runs made on the same machine.
+# Server CPU and memory come from /proc (Linux).
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import websockets
+
+from configuration import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def server_processes(pid):
+    """The server and, in cluster mode, its workers"""
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def server_usage(pid):
+    """(cpu seconds, resident bytes) summed over the server processes"""
+    cpu = rss = 0
+    for process in server_processes(pid):
+        try:
+            with open(f'/proc/{process}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{process}/statm') as f:
+                resident = int(f.read().split()[1])
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+        rss += resident * PAGE_SIZE
+    return cpu, rss
+
+
+def server_loop_lag(port):
+    """Loop lag as reported by /stats, from whichever worker answers"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as response:
+            return json.load(response)['loop_lag']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p90_ms': percentile(values, 90) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+class Bench:
+    def __init__(self, url, token):
+        self.url = f"{url}?token={token}"
+        self.sent = {}        # bench message number -> send time
+        self.received = {}    # bench message number -> receipt times
+        self.clients = []
+
+    async def connect(self, count, concurrency):
+        gate = asyncio.Semaphore(concurrency)
+
+        async def open_one():
+            async with gate:
+                websocket = await websockets.connect(self.url, max_size=None, ping_interval=None)
+            self.clients.append(websocket)
+            asyncio.create_task(self.listen(websocket))
+
+        await asyncio.gather(*[open_one() for _ in range(count)])
+
+    async def listen(self, websocket):
+        try:
+            async for raw in websocket:
+                now = time.time()
+                data = json.loads(raw)
+                for message in data if isinstance(data, list) else [data]:
+                    if message.get('type') == 'new_message' and message['text'].startswith('bench '):
+                        number = int(message['text'].split()[1])
+                        self.received.setdefault(number, []).append(now)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def drive(self, rate, duration, senders):
+        """Send rate messages per second, spread over several connections to stay under the rate limit"""
+        total = int(rate * duration)
+        dialogue_ids = ['1', '2', '3', '4', '5']
+        started = time.perf_counter()
+        for number in range(total):
+            delay = number / rate - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sender = self.clients[number % senders]
+            self.sent[number] = time.time()
+            await sender.send(json.dumps({
+                'type': 'send_message',
+                'dialogueId': dialogue_ids[number % len(dialogue_ids)],
+                'text': f"bench {number}",
+                'tempId': number,
+            }))
+
+    async def settle(self, timeout):
+        """Wait until every client has every message, or timeout"""
+        deadline = time.perf_counter() + timeout
+        expected = len(self.clients)
+        while time.perf_counter() < deadline:
+            if all(len(self.received.get(number, ())) >= expected for number in self.sent):
+                return
+            await asyncio.sleep(0.05)
+
+    def results(self):
+        latencies, broadcasts = [], []
+        for number, sent_at in self.sent.items():
+            times = self.received.get(number, [])
+            latencies += [t - sent_at for t in times]
+            if len(times) == len(self.clients):
+                broadcasts.append(max(times) - sent_at)
+        expected = len(self.sent) * len(self.clients)
+        return {
+            'delivery_latency': summarize(latencies),
+            'broadcast_duration': summarize(broadcasts),
+            'delivered': len(latencies),
+            'expected': expected,
+            'delivery_ratio': len(latencies) / expected if expected else 0.0,
+        }
+
+
+async def wait_for_server(url, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            websocket = await websockets.connect(url)
+            await websocket.close()
+            return
+        except (OSError, websockets.exceptions.InvalidHandshake):
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run(args, server_pid):
+    url = f"ws://127.0.0.1:{args.port}/ws"
+    token = jwt.encode({'sub': 'bench_user', 'exp': datetime.now(timezone.utc) + timedelta(hours=1)},
+                       SECRET_KEY, algorithm=ALGORITHM)
+    await wait_for_server(f"{url}?token={token}")
+    bench = Bench(url, token)
+
+    _, rss_idle = server_usage(server_pid)
+    connect_started = time.perf_counter()
+    await bench.connect(args.clients, args.connect_concurrency)
+    connect_seconds = time.perf_counter() - connect_started
+    await asyncio.sleep(1)  # Let presence and initial traffic settle
+    _, rss_connected = server_usage(server_pid)
+
+    senders = args.senders or max(1, math.ceil(args.rate / (RATE_LIMIT_FRAMES_PER_SECOND / 2)))
+    cpu_before, _ = server_usage(server_pid)
+    drive_started = time.perf_counter()
+    await bench.drive(args.rate, args.duration, min(senders, len(bench.clients)))
+    await bench.settle(args.settle)
+    elapsed = time.perf_counter() - drive_started
+    cpu_after, rss_after = server_usage(server_pid)
+    loop_lag = await asyncio.to_thread(server_loop_lag, args.port)
+
+    for websocket in bench.clients:
+        await websocket.close()
+
+    results = bench.results()
+    results.update({
+        'connect_seconds': connect_seconds,
+        'server_cpu_seconds': cpu_after - cpu_before,
+        'server_cpu_percent': (cpu_after - cpu_before) / elapsed * 100,
+        'server_cpu_us_per_delivery': (cpu_after - cpu_before) / max(results['delivered'], 1) * 1e6,
+        'server_rss_idle_mb': rss_idle / 1024 / 1024,
+        'server_rss_connected_mb': rss_connected / 1024 / 1024,
+        'server_rss_end_mb': rss_after / 1024 / 1024,
+        'server_bytes_per_connection': (rss_connected - rss_idle) / args.clients,
+        'senders': senders,
+        'server_loop_lag': loop_lag,
+    })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure chat server fan-out with N clients')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=10, help='send_message frames per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--senders', type=int, help='connections that send, default keeps each under the rate limit')
+    parser.add_argument('--settle', type=float, default=30, help='seconds to wait for stragglers')
+    parser.add_argument('--workers', type=int, default=1, help='server processes (server.py --workers)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='handshakes in flight')
+    parser.add_argument('--json', dest='json_path', help='also write results to this file')
+    args = parser.parse_args()
+
+    # Every client needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.clients + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    if args.clients * 1 > MAX_CONNECTIONS * args.workers:
+        print(f"⚠️  MAX_CONNECTIONS is {MAX_CONNECTIONS} per process, add --workers or raise it")
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'server.py'), '--port', str(args.port), '--workers', str(args.workers)],
+        cwd=HERE, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        results = asyncio.run(run(args, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+    latency = results['delivery_latency']
+    broadcast = results['broadcast_duration']
+    print(f"\n📊 {args.clients} clients, {args.rate:g} msg/s for {args.duration:g}s, {args.workers} worker(s)")
+    print(f"   delivered      {results['delivered']}/{results['expected']} ({results['delivery_ratio']:.1%})")
+    if latency:
+        print(f"   new_message    p50 {latency['p50_ms']:.1f} ms  p90 {latency['p90_ms']:.1f} ms  "
+              f"p99 {latency['p99_ms']:.1f} ms  max {latency['max_ms']:.1f} ms")
+    if broadcast:
+        print(f"   broadcast      p50 {broadcast['p50_ms']:.1f} ms  p99 {broadcast['p99_ms']:.1f} ms")
+    print(f"   server CPU     {results['server_cpu_percent']:.0f}% "
+          f"({results['server_cpu_us_per_delivery']:.1f} µs per delivery)")
+    print(f"   server memory  {results['server_bytes_per_connection'] / 1024:.1f} KiB per connection, "
+          f"{results['server_rss_end_mb']:.0f} MB at the end")
+    lag = results['server_loop_lag']
+    if lag:
+        print(f"   server loop    lag p50 {lag['p50_ms']:.1f} ms  p99 {lag['p99_ms']:.1f} ms  "
+              f"max {lag['max_ms']:.1f} ms, {lag['stalls']} stalls")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'config': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# bench_memory.py
+# Compare memory per stored chat message: the old seven-key dicts against
+# the slotted ChatMessage records the server keeps now.
+#
+#   python bench_memory.py                   # table on stdout
+#   python bench_memory.py --json out.json   # machine-readable results too
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from chat_history import ChatMessage
+
+
+def sample_rows(count, seed, dialogue_count=50):
+    """(dialogue_id, text, is_me, sent_at) tuples shared by both layouts"""
+    rng = random.Random(seed)
+    words = ['lunch', 'order', 'delivery', 'tomorrow', 'thanks', 'price', 'apples',
+             'milk', 'invoice', 'ok', 'see', 'you', 'the', 'can', 'send', 'files']
+    now = time.time()
+    rows = []
+    for i in range(count):
+        # Build ids at runtime so they aren't shared constants, like ids parsed off the wire
+        dialogue_id = ''.join(['dialogue_', str(rng.randrange(dialogue_count))])
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 20)))
+        rows.append((dialogue_id, text, rng.random() < 0.5, now - (count - i)))
+    return rows
+
+
+def build_dicts(rows):
+    store = {}
+    for number, (dialogue_id, text, is_me, sent_at) in enumerate(rows, start=101):
+        history = store.setdefault(dialogue_id, [])
+        history.append({
+            'id': f"msg_{dialogue_id}_{number}",
+            'dialogueId': dialogue_id,
+            'seq': len(history) + 1,
+            'text': text,
+            'isMe': is_me,
+            'timestamp': datetime.fromtimestamp(sent_at).isoformat(),
+            'isDelivered': True,
+        })
+    return store
+
+
+def build_records(rows):
+    store = {}
+    for number, (dialogue_id, text, is_me, sent_at) in enumerate(rows, start=101):
+        history = store.setdefault(dialogue_id, [])
+        history.append(ChatMessage(dialogue_id, len(history) + 1, number, text, is_me, sent_at))
+    return store
+
+
+def measure(build, rows):
+    """Bytes allocated by build(rows) and still alive afterwards, texts excluded"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    store = build(rows)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del store
+    return {
+        'bytes_per_message': used / len(rows),
+        'total_mb': used / 1024 / 1024,
+        'build_us_per_message': elapsed / len(rows) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare chat message storage layouts')
+    parser.add_argument('--messages', type=int, default=200000, help='chat messages to store')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', dest='json_path', help='also write results to this file')
+    args = parser.parse_args()
+
+    rows = sample_rows(args.messages, args.seed)
+    results = {
+        'dict': measure(build_dicts, rows),
+        'ChatMessage': measure(build_records, rows),
+    }
+
+    print(f"\n{'layout':<12} {'bytes/msg':>10} {'total MB':>10} {'build µs':>10}")
+    print("-" * 45)
+    for name, row in results.items():
+        print(f"{name:<12} {row['bytes_per_message']:>10.1f} {row['total_mb']:>10.1f} "
+              f"{row['build_us_per_message']:>10.2f}")
+    saved = 1 - results['ChatMessage']['bytes_per_message'] / results['dict']['bytes_per_message']
+    print(f"\n💾 ChatMessage uses {saved:.0%} less memory per message")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'messages': args.messages, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# bench_protocol.py
+# Compare bytes on the wire and CPU per message for each chat socket mode:
+# JSON or MessagePack frames, with or without permessage-deflate.
+#
+#   python bench_protocol.py                 # table on stdout
+#   python bench_protocol.py --json out.json # machine-readable results too
+import argparse
+import json
+import random
+import time
+import zlib
+
+from configuration import *
+from chat_protocol import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, encode_frame, decode_frame, msgpack
+import server
+
+
+class DeflateStream:
+    """One direction of a permessage-deflate connection with context takeover"""
+
+    def __init__(self, level, mem_level, window_bits, min_size):
+        self.min_size = min_size
+        self.encoder = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+        self.decoder = zlib.decompressobj(-window_bits)
+
+    def compress(self, data):
+        if len(data) < self.min_size:
+            return data, False
+        data = self.encoder.compress(data) + self.encoder.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-4], True
+
+    def decompress(self, data, compressed):
+        if not compressed:
+            return data
+        return self.decoder.decompress(data + b'\x00\x00\xff\xff')
+
+
+def sample_events(count, seed):
+    """A chat-like event stream: every message produces new_message + dialogue_updated"""
+    rng = random.Random(seed)
+    words = ['lunch', 'order', 'delivery', 'tomorrow', 'thanks', 'price', 'apples',
+             'milk', 'invoice', 'ok', 'see', 'you', 'the', 'can', 'send', 'files']
+    dialogue_ids = list(server.dialogues.keys())
+    events = []
+    for _ in range(count):
+        dialogue_id = rng.choice(dialogue_ids)
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 20)))
+        msg = server.store_message(dialogue_id, text, is_me=rng.random() < 0.5)
+        events.append({'type': 'new_message', **server.message_to_wire(msg)})
+        events.append({'type': 'dialogue_updated',
+                       'dialogue': server.dialogue_to_wire(server.dialogues[dialogue_id])})
+    history = {
+        'type': 'message_history',
+        'dialogueId': dialogue_ids[0],
+        'messages': [server.message_to_wire(m) for m in server.messages[dialogue_ids[0]].hot[-50:]],
+    }
+    dialogues = {
+        'type': 'initial_dialogues',
+        'dialogues': [server.dialogue_to_wire(d) for d in server.dialogues.values()],
+    }
+    return events + [history, dialogues]
+
+
+def run_mode(events, subprotocol, deflate):
+    stream = None
+    if deflate:
+        stream = DeflateStream(WS_COMPRESSION_LEVEL, WS_COMPRESSION_MEM_LEVEL,
+                               WS_COMPRESSION_WINDOW_BITS, WS_COMPRESSION_MIN_SIZE)
+    per_type = {}
+    for event in events:
+        start = time.perf_counter()
+        frame = encode_frame(subprotocol, event)
+        raw = frame.encode() if isinstance(frame, str) else frame
+        wire, compressed = stream.compress(raw) if stream else (raw, False)
+        encoded = time.perf_counter()
+        data = stream.decompress(wire, compressed) if stream else wire
+        decode_frame(data.decode() if subprotocol == JSON_SUBPROTOCOL else data)
+        decoded = time.perf_counter()
+
+        stats = per_type.setdefault(event['type'], {
+            'messages': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'encode_s': 0.0, 'decode_s': 0.0,
+        })
+        stats['messages'] += 1
+        stats['raw_bytes'] += len(raw)
+        stats['wire_bytes'] += len(wire)
+        stats['encode_s'] += encoded - start
+        stats['decode_s'] += decoded - encoded
+
+    total = {'messages': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'encode_s': 0.0, 'decode_s': 0.0}
+    for stats in per_type.values():
+        for key in total:
+            total[key] += stats[key]
+    per_type['all'] = total
+
+    return {
+        message_type: {
+            'messages': stats['messages'],
+            'wire_bytes_per_message': stats['wire_bytes'] / stats['messages'],
+            'raw_bytes_per_message': stats['raw_bytes'] / stats['messages'],
+            'encode_us_per_message': stats['encode_s'] / stats['messages'] * 1e6,
+            'decode_us_per_message': stats['decode_s'] / stats['messages'] * 1e6,
+        }
+        for message_type, stats in per_type.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare chat socket wire formats')
+    parser.add_argument('--messages', type=int, default=5000, help='chat messages to simulate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', dest='json_path', help='also write results to this file')
+    args = parser.parse_args()
+
+    events = sample_events(args.messages, args.seed)
+    modes = [('json', JSON_SUBPROTOCOL, False), ('json+deflate', JSON_SUBPROTOCOL, True)]
+    if msgpack is not None:
+        modes += [('msgpack', MSGPACK_SUBPROTOCOL, False), ('msgpack+deflate', MSGPACK_SUBPROTOCOL, True)]
+    else:
+        print("⚠️  msgpack is not installed, skipping MessagePack modes")
+
+    results = {name: run_mode(events, subprotocol, deflate) for name, subprotocol, deflate in modes}
+
+    print(f"\n{'mode':<16} {'type':<18} {'bytes/msg':>10} {'raw/msg':>10} {'enc µs':>8} {'dec µs':>8}")
+    print("-" * 75)
+    for name, per_type in results.items():
+        for message_type, row in per_type.items():
+            print(f"{name:<16} {message_type:<18} {row['wire_bytes_per_message']:>10.1f} "
+                  f"{row['raw_bytes_per_message']:>10.1f} {row['encode_us_per_message']:>8.2f} "
+                  f"{row['decode_us_per_message']:>8.2f}")
+        print("-" * 75)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'messages': args.messages,
+                'compression': {
+                    'level': WS_COMPRESSION_LEVEL,
+                    'memLevel': WS_COMPRESSION_MEM_LEVEL,
+                    'windowBits': WS_COMPRESSION_WINDOW_BITS,
+                    'minSize': WS_COMPRESSION_MIN_SIZE,
+                },
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
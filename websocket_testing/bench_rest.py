@@ -0,0 +1,312 @@
+# bench_rest.py
+# Benchmark the REST API in main.py on large synthetic data, in-process.
+#
+#   python bench_rest.py --items 10000 --orders 50000
+#   python bench_rest.py --items 1000000 --orders 2000000 --mix orders --json rest.json
+#
+# Catalog, users and orders are generated with numpy from a seed, so runs are
+# comparable between commits. Requests go through httpx's ASGI transport
+# straight into the FastAPI app: no sockets, no server process, no lifespan
+# (nothing is written to ./data).
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import Counter
+
+import httpx
+import numpy as np
+import pandas as pd
+
+import main
+from loop_monitor import LoopMonitor
+
+CATEGORIES = np.array(['Fruits', 'Vegetables', 'Dairy', 'Bakery', 'Beverages', 'Meat', 'Fish',
+                       'Grains', 'Snacks', 'Frozen', 'Spices', 'Household'])
+UNITS = np.array(['kg', 'g', 'l', 'piece', 'pack', 'box'])
+ADJECTIVES = np.array(['Organic', 'Fresh', 'Premium', 'Local', 'Classic', 'Spicy', 'Sweet',
+                       'Smoked', 'Whole', 'Light', 'Crispy', 'Aged'])
+NOUNS = np.array(['Apples', 'Tomatoes', 'Milk', 'Yogurt', 'Carrots', 'Bread', 'Cheese', 'Juice',
+                  'Tea', 'Coffee', 'Rice', 'Beans', 'Chicken', 'Salmon', 'Cookies', 'Honey'])
+STATUSES = np.array(['pending', 'confirmed', 'processing', 'shipped', 'delivered', 'cancelled'])
+ADDRESSES = np.array(['Kabanbay Batyr Ave 53, Astana, Kazakhstan',
+                      'Mangilik El Ave 55/20, Astana, Kazakhstan',
+                      'Abay Ave 10, Almaty, Kazakhstan'])
+
+# Share of requests per endpoint in each scripted mix
+MIXES = {
+    'browse': {'get_items': 0.3, 'get_categories': 0.1, 'get_item_by_id': 0.45,
+               'get_user_orders': 0.1, 'create_order': 0.05},
+    'checkout': {'get_items': 0.1, 'get_item_by_id': 0.3, 'create_order': 0.4,
+                 'get_user_orders': 0.2},
+    'orders': {'get_user_orders': 0.8, 'create_order': 0.2},
+    'catalog': {'get_items': 0.5, 'get_categories': 0.2, 'get_item_by_id': 0.3},
+}
+
+
+def generate_users(rng, consumers, suppliers):
+    """fake_users_db entries, keyed by username like data/users_db.json"""
+    users = {}
+    for number in range(1, consumers + suppliers + 1):
+        user_type = 'supplier' if number > consumers else 'consumer'
+        username = f"bench{number}"
+        users[username] = {
+            'id': f"user_{number}",
+            'name': 'Bench', 'surname': str(number), 'username': username,
+            'email': f"{username}@example.com",
+            'businessName': f"Business {number}", 'businessType': 'restaurant',
+            'userType': user_type, 'hashed_password': '', 'created_at': '2025-01-01T00:00:00',
+        }
+    return users
+
+
+def generate_catalog(rng, count, supplier_ids):
+    """Catalog DataFrame with the columns main.py reads from catalog_db.csv"""
+    numbers = np.arange(1, count + 1)
+    adjectives = ADJECTIVES[rng.integers(0, len(ADJECTIVES), count)]
+    nouns = NOUNS[rng.integers(0, len(NOUNS), count)]
+    names = pd.Series(adjectives).str.cat(pd.Series(nouns), sep=' ')
+    price = np.round(rng.uniform(100, 5000, count), -1)
+    quantity = rng.integers(10, 500, count)
+    return pd.DataFrame({
+        'id': pd.Series(numbers).map('prod_{:07d}'.format),
+        # Sorted so each supplier owns one contiguous range of rows
+        'supplier': np.sort(np.asarray(supplier_ids)[rng.integers(0, len(supplier_ids), count)]),
+        'name': names,
+        'description': names + ' from a local producer.',
+        'price': price,
+        'weight': np.round(rng.uniform(0.1, 5, count), 2),
+        'quantity': quantity,
+        'category': CATEGORIES[rng.integers(0, len(CATEGORIES), count)],
+        'unit': UNITS[rng.integers(0, len(UNITS), count)],
+        'discount_percent': rng.choice([0.0, 0.0, 0.0, 5.0, 10.0, 15.0], count),
+        'min_order_qty': np.ones(count, dtype=int),
+        'stock_level': quantity,
+        'is_available': rng.random(count) < 0.95,
+        'image_url': 'https://images.unsplash.com/photo-1568702846914-96b305d2aaeb',
+        'created_at': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365 * 86400, count), unit='s'),
+    })
+
+
+def generate_orders(rng, count, catalog, consumer_ids, max_items=5):
+    """fake_orders_db entries. Columns are drawn as arrays, dicts are built once at the end"""
+    if count == 0:
+        return {}
+    suppliers, starts, sizes = np.unique(catalog['supplier'].to_numpy(), return_index=True, return_counts=True)
+    order_supplier = rng.integers(0, len(suppliers), count)
+    item_counts = rng.integers(1, max_items + 1, count)
+    total_lines = int(item_counts.sum())
+    line_order = np.repeat(np.arange(count), item_counts)
+    # An order only contains items of its supplier
+    line_item = starts[order_supplier[line_order]] + (
+        rng.random(total_lines) * sizes[order_supplier[line_order]]).astype(np.int64)
+    line_quantity = rng.integers(1, 6, total_lines)
+
+    final_price = catalog['price'].to_numpy() * (1 - catalog['discount_percent'].to_numpy() / 100)
+    totals = np.round(np.bincount(line_order, weights=final_price[line_item] * line_quantity), 2)
+
+    # Order items are stored as catalog rows, like fake.py does
+    used = np.unique(line_item)
+    rows = catalog.iloc[used].assign(created_at=catalog['created_at'].iloc[used].dt.strftime('%Y-%m-%d %H:%M:%S'))
+    records = dict(zip(used.tolist(), rows.to_dict('records')))
+
+    created = pd.Timestamp('2025-06-01') + pd.to_timedelta(rng.integers(0, 180 * 86400, count), unit='s')
+    created = created.strftime('%Y-%m-%d %H:%M:%S').tolist()
+    users = np.asarray(consumer_ids)[rng.integers(0, len(consumer_ids), count)].tolist()
+    statuses = STATUSES[rng.integers(0, len(STATUSES), count)].tolist()
+    addresses = ADDRESSES[rng.integers(0, len(ADDRESSES), count)].tolist()
+    supplier_names = suppliers[order_supplier].tolist()
+    boundaries = np.concatenate([[0], np.cumsum(item_counts)]).tolist()
+    line_item = line_item.tolist()
+
+    orders = {}
+    for i in range(count):
+        order_id = f"order_{i + 1}"
+        orders[order_id] = {
+            'id': order_id,
+            'user_id': users[i],
+            'supplier_id': supplier_names[i],
+            'items': [records[item] for item in line_item[boundaries[i]:boundaries[i + 1]]],
+            'total_amount': float(totals[i]),
+            'delivery_address': addresses[i],
+            'notes': '',
+            'status': statuses[i],
+            'created_at': created[i],
+            'updated_at': created[i],
+        }
+    return orders
+
+
+def install(users, catalog, orders):
+    """Swap the generated data into main.py's in-memory databases"""
+    main.fake_users_db = users
+    main.fake_catalog_db = catalog
+    main.fake_orders_db = orders
+    main.fake_link_db = {}
+    main.reset_catalog()
+
+
+def build_requests(rng, count, mix, catalog, consumer_ids, view=None):
+    """(endpoint, method, url, body) for the whole run, drawn up front, list reads ask for view"""
+    projection = f"&view={view}" if view else ''
+    endpoints = list(MIXES[mix])
+    weights = np.array([MIXES[mix][endpoint] for endpoint in endpoints])
+    picks = rng.choice(len(endpoints), count, p=weights / weights.sum())
+    item_ids = catalog['id'].to_numpy()
+    categories = catalog['category'].unique()
+
+    # A pool of order bodies, each with items of one supplier
+    bodies = []
+    by_supplier = catalog.groupby('supplier').indices
+    suppliers = list(by_supplier)
+    for _ in range(min(count, 500)):
+        supplier = suppliers[rng.integers(0, len(suppliers))]
+        rows = catalog.iloc[rng.choice(by_supplier[supplier], min(3, len(by_supplier[supplier])), replace=False)]
+        items = [main.row_to_item_response(row).model_dump() for _, row in rows.iterrows()]
+        bodies.append({
+            'user_id': consumer_ids[rng.integers(0, len(consumer_ids))],
+            'supplier_id': supplier,
+            'items': items,
+            'total_amount': round(sum(item['finalPrice'] for item in items), 2),
+            'delivery_address': ADDRESSES[0],
+        })
+
+    requests = []
+    for pick in picks:
+        endpoint = endpoints[pick]
+        user_id = consumer_ids[rng.integers(0, len(consumer_ids))]
+        if endpoint == 'get_items':
+            # Unfiltered lists scale with the catalog, the app filters by category or search
+            if rng.random() < 0.5:
+                params = f"category={categories[rng.integers(0, len(categories))]}"
+            else:
+                params = f"search={NOUNS[rng.integers(0, len(NOUNS))].lower()}"
+            requests.append((endpoint, 'GET', f"/api/items/?user_id={user_id}&{params}{projection}", None))
+        elif endpoint == 'get_categories':
+            requests.append((endpoint, 'GET', f"/api/categories/{user_id}", None))
+        elif endpoint == 'get_item_by_id':
+            requests.append((endpoint, 'GET', f"/api/items/{item_ids[rng.integers(0, len(item_ids))]}", None))
+        elif endpoint == 'get_user_orders':
+            requests.append((endpoint, 'GET', f"/api/orders/{user_id}" + projection.replace('&', '?'), None))
+        elif endpoint == 'create_order':
+            requests.append((endpoint, 'POST', '/api/orders/', bodies[rng.integers(0, len(bodies))]))
+    return requests
+
+
+def blocking_sites(stalls):
+    """Innermost main.py frame of each stall, the handler that held the loop"""
+    sites = Counter()
+    for stall in stalls:
+        frames = re.findall(r'File "%s", line (\d+), in (\w+)' % re.escape(main.__file__), stall['stack'])
+        if frames:
+            line, function = frames[-1]
+            sites[f"{function} (main.py:{line})"] += 1
+    return dict(sites.most_common())
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def run_requests(requests, concurrency, encoding='identity'):
+    timings = {}  # endpoint -> list of seconds
+    sizes = {}    # endpoint -> response bytes
+    errors = {}
+    queue = iter(requests)
+    transport = httpx.ASGITransport(app=main.app)
+    monitor = LoopMonitor(kept=100000)  # Every stall, for the blocking report
+    monitor.start()
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None,
+                                 headers={'Accept-Encoding': encoding}) as client:
+        async def worker():
+            for endpoint, method, url, body in queue:
+                started = time.perf_counter()
+                response = await client.request(method, url, json=body)
+                timings.setdefault(endpoint, []).append(time.perf_counter() - started)
+                sizes[endpoint] = sizes.get(endpoint, 0) + response.num_bytes_downloaded  # As sent
+                if response.status_code >= 400:
+                    errors[endpoint] = errors.get(endpoint, 0) + 1
+                # The in-memory transport never suspends; a socket would hand each
+                # request to the loop separately, and timers run in between
+                await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+    monitor.stop()
+
+    lag = monitor.stats()
+    lag['blocking'] = blocking_sites(lag.pop('recent_stalls'))
+    results = {'requests': len(requests), 'seconds': elapsed,
+               'requests_per_second': len(requests) / elapsed, 'endpoints': {}, 'loop_lag': lag}
+    for endpoint, values in sorted(timings.items()):
+        values.sort()
+        results['endpoints'][endpoint] = {
+            'requests': len(values),
+            'errors': errors.get(endpoint, 0),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p90_ms': percentile(values, 90) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+            'mean_bytes': sizes[endpoint] / len(values),
+        }
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark the REST API on synthetic data')
+    parser.add_argument('--items', type=int, default=10000, help='catalog size')
+    parser.add_argument('--orders', type=int, default=10000, help='orders in history')
+    parser.add_argument('--consumers', type=int, default=200)
+    parser.add_argument('--suppliers', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    parser.add_argument('--view', choices=['full', 'summary'], help='view asked for by item and order lists')
+    parser.add_argument('--encoding', choices=['identity', 'gzip', 'br'], default='identity',
+                        help='Accept-Encoding of the requests')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', dest='json_path', help='also write results to this file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    users = generate_users(rng, args.consumers, args.suppliers)
+    consumer_ids = [u['id'] for u in users.values() if u['userType'] == 'consumer']
+    supplier_ids = [u['id'] for u in users.values() if u['userType'] == 'supplier']
+    catalog = generate_catalog(rng, args.items, supplier_ids)
+    orders = generate_orders(rng, args.orders, catalog, consumer_ids)
+    generate_seconds = time.perf_counter() - started
+    print(f"🧪 Generated {args.items} items, {args.orders} orders and {len(users)} users in {generate_seconds:.1f}s")
+
+    install(users, catalog, orders)
+    logging.getLogger('loop').setLevel(logging.ERROR)  # Stalls are summarized in the report
+    requests = build_requests(rng, args.requests, args.mix, catalog, consumer_ids, args.view)
+
+    results = asyncio.run(run_requests(requests, args.concurrency, args.encoding))
+
+    print(f"\n{'endpoint':<18} {'requests':>9} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'KiB':>8}")
+    print("-" * 81)
+    for endpoint, row in results['endpoints'].items():
+        print(f"{endpoint:<18} {row['requests']:>9} {row['errors']:>7} {row['p50_ms']:>8.2f} "
+              f"{row['p90_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} {row['mean_bytes'] / 1024:>8.1f}")
+    print("-" * 81)
+    print(f"📊 {results['requests']} requests in {results['seconds']:.2f}s "
+          f"({results['requests_per_second']:.0f} req/s, concurrency {args.concurrency}, mix {args.mix})")
+    lag = results['loop_lag']
+    print(f"🐢 Loop lag p50 {lag['p50_ms']:.1f} ms  p99 {lag['p99_ms']:.1f} ms  max {lag['max_ms']:.1f} ms, "
+          f"{lag['stalls']} stalls")
+    for site, count in lag['blocking'].items():
+        print(f"   {count:>5}  {site}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'config': vars(args), 'generate_seconds': generate_seconds, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,85 @@
+# broker.py
+# Local pub/sub broker that fans chat events out between server processes.
+#
+# Every worker keeps one Unix socket connection to the broker and speaks
+# newline-delimited JSON:
+#   {'op': 'hello', 'worker': 2}                 register as worker 2
+#   {'op': 'publish', 'event': {...}}            deliver to every worker
+#   {'op': 'send', 'to': 1, 'command': {...}}    deliver to worker 1 only
+# Frames are forwarded verbatim, the broker only parses them to route.
+import asyncio
+import json
+import os
+
+STREAM_LIMIT = 16 * 1024 * 1024  # Longest frame a worker may send
+
+
+class BrokerClient:
+    """Worker side of the broker connection"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, path, worker_id, attempts=50):
+        """Connect and register, retrying while the broker is starting up"""
+        for attempt in range(attempts):
+            try:
+                reader, writer = await asyncio.open_unix_connection(path, limit=STREAM_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(0.1)
+        client = cls(reader, writer)
+        await client.send({'op': 'hello', 'worker': worker_id})
+        return client
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        await self.writer.drain()
+
+    async def publish(self, event):
+        await self.send({'op': 'publish', 'event': event})
+
+    async def send_to(self, worker_id, command):
+        await self.send({'op': 'send', 'to': worker_id, 'command': command})
+
+    async def frames(self):
+        """Yield frames routed to this worker until the broker goes away"""
+        async for line in self.reader:
+            yield json.loads(line)
+
+
+async def run_broker(path):
+    """Serve the broker on a Unix socket until cancelled"""
+    workers = {}  # worker_id -> StreamWriter
+
+    async def handle_worker(reader, writer):
+        hello = json.loads(await reader.readline())
+        worker_id = hello['worker']
+        workers[worker_id] = writer
+        print(f"🔗 Worker {worker_id} joined the broker")
+
+        try:
+            async for line in reader:
+                frame = json.loads(line)
+                if frame['op'] == 'publish':
+                    # Writes are buffered, a slow worker doesn't hold up the others
+                    for worker in workers.values():
+                        worker.write(line)
+                elif frame['op'] == 'send':
+                    target = workers.get(frame['to'])
+                    if target is not None:
+                        target.write(line)
+        finally:
+            workers.pop(worker_id, None)
+            writer.close()
+            print(f"🔌 Worker {worker_id} left the broker")
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle_worker, path, limit=STREAM_LIMIT)
+    async with server:
+        await server.serve_forever()
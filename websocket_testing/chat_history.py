@@ -0,0 +1,194 @@
+# chat_history.py
+# In-memory representation of chat messages for the WebSocket server
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from array import array
+from datetime import datetime
+
+from configuration import *
+from logs import fields
+
+log = logging.getLogger('chat')
+
+
+class ChatMessage:
+    """One chat message, stored compactly and turned into a dict only on the wire.
+
+    A seven-key dict with an ISO timestamp string and an id string costs several
+    hundred bytes per message. Here the id is an integer, the timestamp is epoch
+    seconds and the dialogue id string is interned and shared by every message.
+    """
+    __slots__ = ('dialogue_id', 'seq', 'number', 'text', 'is_me', 'sent_at')
+
+    def __init__(self, dialogue_id, seq, number, text, is_me, sent_at):
+        self.dialogue_id = sys.intern(dialogue_id)
+        self.seq = seq            # Position in the dialogue, starting at 1
+        self.number = number      # Server-wide message counter, the wire id suffix
+        self.text = text
+        self.is_me = is_me
+        self.sent_at = sent_at    # Epoch seconds
+
+    @property
+    def id(self):
+        return f"msg_{self.dialogue_id}_{self.number}"
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.sent_at).isoformat()
+
+    def to_dict(self):
+        """Wire format, without isRead which depends on read watermarks"""
+        return {
+            'id': self.id,
+            'dialogueId': self.dialogue_id,
+            'seq': self.seq,
+            'text': self.text,
+            'isMe': self.is_me,
+            'timestamp': self.timestamp,
+            'isDelivered': True,
+        }
+
+    def to_row(self):
+        """Compact JSON/MessagePack friendly form, e.g. for the broker"""
+        return [self.dialogue_id, self.seq, self.number, self.text, self.is_me, self.sent_at]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    @classmethod
+    def from_dict(cls, data, seq):
+        """Build a message from the dict format, e.g. mock data"""
+        return cls(
+            data['dialogueId'],
+            seq,
+            int(data['id'].rsplit('_', 1)[1]),
+            data['text'],
+            data['isMe'],
+            datetime.fromisoformat(data['timestamp']).timestamp(),
+        )
+
+
+class DialogueHistory:
+    """Messages of one dialogue: the recent ones in memory, older ones on disk.
+
+    Sequence numbers run 1..len(history) without gaps. Messages 1..spilled live
+    in an append-only spill file with one JSON row per line, the rest in hot.
+    Only the byte offset of each spilled row stays in memory (8 bytes each).
+    The file is written in a thread and messages leave hot only once they are
+    on disk, so reads see a consistent split while a spill is running.
+    """
+
+    def __init__(self, dialogue_id):
+        self.dialogue_id = sys.intern(dialogue_id)
+        self.hot = []
+        self.spilled = 0
+        self.offsets = array('Q', [0])  # offsets[i] is where seq i + 1 starts in the file
+        self.path = None
+        self.spilling = False   # One spill at a time, hot only grows meanwhile
+        self.spill_task = None  # Spill started by append(), kept so it isn't collected
+
+    def __len__(self):
+        return self.spilled + len(self.hot)
+
+    def append(self, msg):
+        self.hot.append(msg)
+        # Spill in batches so the file is opened once per HISTORY_SPILL_BATCH messages
+        if len(self.hot) >= HISTORY_HOT_MESSAGES + HISTORY_SPILL_BATCH and not self.spilling:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # No loop, e.g. seeding or a benchmark, the next trim() spills them
+            self.spilling = True
+            self.spill_task = loop.create_task(self.spill(len(self.hot) - HISTORY_HOT_MESSAGES))
+
+    async def trim(self, now):
+        """Apply the retention policy, returns how many messages were spilled"""
+        if self.spilling:
+            return 0
+        count = max(len(self.hot) - HISTORY_HOT_MESSAGES, 0)
+        if HISTORY_HOT_SECONDS:
+            cutoff = now - HISTORY_HOT_SECONDS
+            while count < len(self.hot) and self.hot[count].sent_at < cutoff:
+                count += 1
+        if not count:
+            return 0
+        self.spilling = True
+        return await self.spill(count)
+
+    async def spill(self, count):
+        """Move the oldest count hot messages to the spill file, returns how many moved"""
+        if self.path is None:
+            self.path = spill_path(self.dialogue_id)  # After the fork, so it names the worker
+        try:
+            lines = [
+                json.dumps([msg.seq, msg.number, msg.text, msg.is_me, msg.sent_at]).encode() + b'\n'
+                for msg in self.hot[:count]
+            ]
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_spill, self.path, self.offsets[-1], lines)
+        except OSError:
+            # Keep them in hot, the next append or sweep tries again
+            log.exception("❌ Spilling history failed", extra=fields(dialogue=self.dialogue_id))
+            return 0
+        finally:
+            self.spilling = False
+        for line in lines:
+            self.offsets.append(self.offsets[-1] + len(line))
+        del self.hot[:count]
+        self.spilled += count
+        return count
+
+    async def read(self, before_seq=None, limit=None):
+        """Messages with seq < before_seq (all by default), the last limit of them.
+
+        Spilled rows are read in a thread so scrolling back doesn't block the loop.
+        """
+        last = len(self) if before_seq is None else min(before_seq - 1, len(self))
+        first = 1 if limit is None else max(last - limit + 1, 1)
+        if last < first:
+            return []
+
+        # Slice the hot part now, it may be spilled while the file is being read
+        hot = self.hot[max(first - self.spilled - 1, 0):max(last - self.spilled, 0)]
+        if first > self.spilled:
+            return hot
+        start = self.offsets[first - 1]
+        stop = self.offsets[min(last, self.spilled)]
+        spilled = await asyncio.to_thread(self.read_spilled, start, stop)
+        return spilled + hot
+
+    def read_spilled(self, start, stop):
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(stop - start)
+        return [ChatMessage(self.dialogue_id, *json.loads(line)) for line in data.splitlines()]
+
+
+def spill_directory(pid=None):
+    """Spill files of one process (this one by default), so workers don't share files"""
+    return os.path.join(HISTORY_SPILL_DIR, str(os.getpid() if pid is None else pid))
+
+
+def spill_path(dialogue_id):
+    """Spill file of a dialogue, named by a hash so no id can point outside the directory"""
+    name = hashlib.sha256(dialogue_id.encode()).hexdigest()[:32]
+    return os.path.join(spill_directory(), f"{name}.jsonl")
+
+
+def write_spill(path, start, lines):
+    """Write rows at byte offset start of a spill file, runs in a worker thread"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        f.truncate(start)  # Drops whatever a failed earlier spill left behind
+        f.writelines(lines)
+
+
+def remove_spill_files(pid=None):
+    """History lives in memory only, spill files don't outlive the process that wrote them"""
+    shutil.rmtree(spill_directory(pid), ignore_errors=True)
@@ -0,0 +1,104 @@
+# chat_protocol.py
+# Wire formats and compression settings for the chat WebSocket server
+import json
+
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import Opcode
+
+from configuration import *
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional, JSON always works
+    msgpack = None
+
+# Subprotocols a client may offer in Sec-WebSocket-Protocol, most preferred first
+JSON_SUBPROTOCOL = 'foody.chat.json'
+MSGPACK_SUBPROTOCOL = 'foody.chat.msgpack'
+SUBPROTOCOLS = [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL] if msgpack else [JSON_SUBPROTOCOL]
+
+
+class FrameDecodeError(ValueError):
+    """Raised when an inbound frame can't be decoded"""
+
+
+def select_subprotocol(connection, subprotocols):
+    """Pick the preferred subprotocol, clients offering none get plain JSON"""
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+
+def encode_frame(subprotocol, payload):
+    """Encode a message (or a batch of messages) for the negotiated subprotocol"""
+    if subprotocol == MSGPACK_SUBPROTOCOL:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload)
+
+
+def decode_frame(frame):
+    """Decode an inbound frame, binary frames are MessagePack"""
+    try:
+        if isinstance(frame, bytes):
+            if msgpack is None:
+                raise FrameDecodeError('Binary frames are not supported')
+            return msgpack.unpackb(frame, raw=False)
+        return json.loads(frame)
+    except FrameDecodeError:
+        raise
+    except ValueError as e:  # JSONDecodeError and msgpack errors
+        raise FrameDecodeError(str(e)) from e
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves messages below min_size uncompressed"""
+
+    def __init__(self, *args, min_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        # RFC 7692 compresses per message, the RSV1 bit stays clear on skipped ones
+        if frame.opcode in (Opcode.TEXT, Opcode.BINARY) and frame.fin and len(frame.data) < self.min_size:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    """Server extension factory producing ThresholdPerMessageDeflate"""
+
+    def __init__(self, *args, min_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+def compression_extensions():
+    """Extensions for websockets.serve built from the configured deflate settings"""
+    if not WS_COMPRESSION:
+        return []
+    return [
+        ThresholdDeflateFactory(
+            server_max_window_bits=WS_COMPRESSION_WINDOW_BITS,
+            client_max_window_bits=WS_COMPRESSION_WINDOW_BITS,
+            compress_settings={
+                'level': WS_COMPRESSION_LEVEL,
+                'memLevel': WS_COMPRESSION_MEM_LEVEL,
+            },
+            min_size=WS_COMPRESSION_MIN_SIZE,
+        )
+    ]
@@ -0,0 +1,142 @@
+# compression.py
+# Response compression for the API, negotiated from Accept-Encoding.
+#
+# Brotli when the client accepts it and the module is installed, gzip
+# otherwise. Bodies under COMPRESSION_MIN_SIZE, non-text content types and
+# streamed responses go out as they are. Bodies of COMPRESSION_OFFLOAD_SIZE
+# and up are compressed in a worker thread (zlib and brotli release the GIL),
+# so a large catalog page doesn't hold up the event loop. Bytes in, bytes out
+# and CPU time per encoding are recorded in metrics, the ratio of the first
+# two against the third is the trade-off to tune the levels with.
+import asyncio
+import gzip
+import time
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip always works
+    brotli = None
+
+from configuration import (COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_MIN_SIZE,
+                           COMPRESSION_OFFLOAD_SIZE)
+from metrics import Counter, Histogram
+
+# Encodings we produce, most preferred first when the client ranks them equally
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'image/svg+xml')
+
+bytes_in = Counter('http_compression_bytes_in_total', 'Response bytes before compression', ('encoding',))
+bytes_out = Counter('http_compression_bytes_out_total', 'Response bytes after compression', ('encoding',))
+compress_seconds = Histogram('http_compression_seconds', 'CPU time spent compressing one response', ('encoding',))
+skipped = Counter('http_compression_skipped_total', 'Responses sent uncompressed', ('reason',))
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def timed_compress(body, encoding):
+    """(compressed body, CPU seconds it took), thread time so offloading doesn't count waiting"""
+    started = time.thread_time()
+    compressed = compress(body, encoding)
+    return compressed, time.thread_time() - started
+
+
+def negotiate(accept_encoding):
+    """The encoding to use for an Accept-Encoding header, None for identity"""
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if name:
+            weights[name] = weight
+    best, best_weight = None, 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class CompressionMiddleware:
+    """Compresses whole response bodies. Plain ASGI, like MetricsMiddleware"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        accept = b''
+        for name, value in scope['headers']:
+            if name == b'accept-encoding':
+                accept += value + b','
+        encoding = negotiate(accept.decode('latin-1'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message['type'] == 'http.response.start':
+                start = message  # Held until we know the body
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            headers = start.get('headers', [])
+            reason = None
+            if message.get('more_body', False):
+                reason = 'streamed'
+            elif any(name == b'content-encoding' for name, _ in headers):
+                reason = 'encoded'
+            elif len(body) < COMPRESSION_MIN_SIZE:
+                reason = 'small'
+            else:
+                content_type = next((value for name, value in headers if name == b'content-type'), b'')
+                if not content_type.decode('latin-1').startswith(COMPRESSIBLE_TYPES):
+                    reason = 'type'
+            if reason is not None:
+                skipped.inc((reason,))
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            if len(body) >= COMPRESSION_OFFLOAD_SIZE:
+                compressed, cpu = await asyncio.to_thread(timed_compress, body, encoding)
+            else:
+                compressed, cpu = timed_compress(body, encoding)
+            bytes_in.inc((encoding,), len(body))
+            bytes_out.inc((encoding,), len(compressed))
+            compress_seconds.observe(cpu, (encoding,))
+
+            headers = [(name, value) for name, value in headers if name not in (b'content-length', b'vary')]
+            vary = [value for name, value in start.get('headers', []) if name == b'vary']
+            headers += [
+                (b'content-encoding', encoding.encode()),
+                (b'content-length', str(len(compressed)).encode()),
+                (b'vary', b', '.join(vary + [b'Accept-Encoding'])),
+            ]
+            await send({**start, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,4 +1,54 @@
 # Configuration
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
\ No newline at end of file
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# WebSocket chat server
+BATCH_TICK_SECONDS = 0.005  # How long batched connections gather events per frame
+WS_COMPRESSION = True           # Negotiate permessage-deflate with clients that offer it
+WS_COMPRESSION_LEVEL = 6        # zlib level, 1 is fastest, 9 is smallest
+WS_COMPRESSION_MEM_LEVEL = 5    # zlib memLevel, lower uses less memory per connection
+WS_COMPRESSION_WINDOW_BITS = 12 # Sliding window of 4 KiB per direction and connection
+WS_COMPRESSION_MIN_SIZE = 256   # Frames smaller than this are sent uncompressed
+BROKER_SOCKET_PATH = '/tmp/foody_chat_broker.sock'  # Pub/sub between server processes (--workers N)
+REPLAY_BUFFER_SIZE = 10000  # Broadcast events kept for clients resuming a session
+MAX_IN_FLIGHT_PER_CONNECTION = 8  # Frames from one client processed concurrently
+WS_ALLOW_ANONYMOUS = False  # Accept chat connections that carry no token
+HEARTBEAT_INTERVAL = 20  # Seconds of silence before the server pings a connection
+HEARTBEAT_TIMEOUT = 20   # Seconds to wait for the pong before the connection is reaped
+IDLE_TIMEOUT = 600       # Seconds without application frames before closing, 0 disables
+MAX_CONNECTIONS = 10000            # Handshakes beyond this get HTTP 503 (per process)
+RATE_LIMIT_FRAMES_PER_SECOND = 20  # Sustained inbound frames per connection, 0 disables
+RATE_LIMIT_BURST = 40              # Frames a connection may send at once
+HISTORY_HOT_MESSAGES = 500    # Most recent messages per dialogue kept in memory
+HISTORY_HOT_SECONDS = 3600    # Messages older than this are spilled too, 0 keeps by count only
+HISTORY_SPILL_BATCH = 100     # Messages over HISTORY_HOT_MESSAGES gathered before spilling
+HISTORY_SWEEP_INTERVAL = 60   # Seconds between age-based retention sweeps
+HISTORY_SPILL_DIR = '/tmp/foody_chat_history'  # Older messages of each dialogue, per process
+PRESENCE_FLUSH_INTERVAL = 1.0  # Seconds between batched presence frames
+PRESENCE_OFFLINE_GRACE = 15    # A user must stay disconnected this long to be shown offline
+DIALOGUE_PAGE_MAX = 200        # Largest limit a get_dialogues page may ask for
+SEARCH_PAGE_MAX = 100          # Largest limit a search_messages page may ask for
+
+# Logging (logs.py), shared by the API and the chat server
+LOG_LEVEL = 'INFO'       # DEBUG adds sampled per-frame events, WARNING for production
+LOG_FORMAT = 'text'      # 'text' for key=value lines, 'json' for one object per line
+LOG_SAMPLE_RATE = 0.01   # Share of per-frame DEBUG events that are written
+LOG_QUEUE_SIZE = 10000   # Records waiting for the writer thread, more are dropped
+
+# Event loop lag monitor (loop_monitor.py), shared by the API and the chat server
+LOOP_LAG_INTERVAL = 0.1      # Seconds between lag samples
+LOOP_STALL_THRESHOLD = 0.1   # A loop blocked longer than this gets a stack snapshot
+LOOP_LAG_WINDOW = 3000       # Samples kept for percentiles, 5 minutes at the interval above
+LOOP_STALLS_KEPT = 20        # Most recent stall snapshots kept for stats
+
+# Sampling profiler (profiler.py), /admin/profile in the API and 'profile' in the chat console
+PROFILE_INTERVAL = 0.005     # Seconds between stack samples while a profile runs
+PROFILE_MAX_SECONDS = 120    # Longest profile a single request may ask for
+ADMIN_USERNAMES = []         # Users whose token opens /admin endpoints, none by default
+
+# REST response compression (compression.py)
+COMPRESSION_MIN_SIZE = 1024          # Bodies smaller than this are sent uncompressed
+COMPRESSION_GZIP_LEVEL = 6           # zlib level, 1 is fastest, 9 is smallest
+COMPRESSION_BROTLI_QUALITY = 4       # 0-11, past 5 JSON gets little smaller for much more CPU
+COMPRESSION_OFFLOAD_SIZE = 64 * 1024 # Bodies from this size are compressed in a worker thread
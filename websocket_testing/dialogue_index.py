@@ -0,0 +1,113 @@
+# dialogue_index.py
+# Dialogue ids ordered by last activity, for paging through the dialogue list
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+
+class DialogueIndex:
+    """Dialogue ids sorted by last activity (newest first) plus a change log.
+
+    Sort keys are (-activity, dialogue_id) tuples kept in buckets of at most
+    2 * load keys. Moving a dialogue is a bisect over the bucket maxima and an
+    insort into one small bucket, so it stays cheap with many dialogues.
+
+    Every change bumps version; changed remembers the version each dialogue was
+    last changed at, most recent last, for "updated since" queries.
+    """
+
+    def __init__(self, load=256):
+        self.load = load
+        self.buckets = []   # Sorted lists of keys, each bucket after the previous one
+        self.maxes = []     # Last key of each bucket
+        self.keys = {}      # dialogue_id -> current key
+        self.version = 0
+        self.changed = OrderedDict()  # dialogue_id -> version, oldest change first
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            for key in bucket:
+                yield key[1]
+
+    def update(self, dialogue_id, activity):
+        """Place a dialogue by its last activity (epoch seconds) and record the change"""
+        key = (-activity, dialogue_id)
+        old = self.keys.get(dialogue_id)
+        if old != key:
+            if old is not None:
+                self.remove_key(old)
+            self.insert_key(key)
+            self.keys[dialogue_id] = key
+        self.touch(dialogue_id)
+
+    def touch(self, dialogue_id):
+        """Record a change that doesn't move the dialogue, e.g. read state or presence"""
+        self.version += 1
+        self.changed[dialogue_id] = self.version
+        self.changed.move_to_end(dialogue_id)
+
+    def changed_since(self, version):
+        """Ids changed after version, most recently changed first"""
+        ids = []
+        for dialogue_id in reversed(self.changed):
+            if self.changed[dialogue_id] <= version:
+                break
+            ids.append(dialogue_id)
+        return ids
+
+    def page(self, limit, cursor=None):
+        """Up to limit ids after cursor, and the cursor of the next page (None at the end)"""
+        if limit < 1:
+            raise ValueError(f"Invalid limit: {limit!r}")
+        ids = []
+        after = None if cursor is None else self.parse_cursor(cursor)
+        start = 0 if after is None else bisect_right(self.maxes, after)
+        for i in range(start, len(self.buckets)):
+            bucket = self.buckets[i]
+            j = bisect_right(bucket, after) if i == start and after is not None else 0
+            for key in bucket[j:]:
+                if len(ids) == limit:
+                    return ids, self.cursor(self.keys[ids[-1]])
+                ids.append(key[1])
+        return ids, None
+
+    @staticmethod
+    def cursor(key):
+        return f"{-key[0]!r}|{key[1]}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Key encoded by cursor(), raises ValueError for anything else"""
+        activity, _, dialogue_id = str(cursor).partition('|')
+        if not dialogue_id:
+            raise ValueError(f"Invalid cursor: {cursor!r}")
+        return (-float(activity), dialogue_id)
+
+    def insert_key(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            i -= 1
+            self.buckets[i].append(key)
+            self.maxes[i] = key
+        else:
+            insort(self.buckets[i], key)
+        bucket = self.buckets[i]
+        if len(bucket) > 2 * self.load:
+            self.buckets[i:i + 1] = [bucket[:self.load], bucket[self.load:]]
+            self.maxes[i:i + 1] = [bucket[self.load - 1], bucket[-1]]
+
+    def remove_key(self, key):
+        i = bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        if not bucket:
+            del self.buckets[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = bucket[-1]
@@ -0,0 +1,111 @@
+# logs.py
+# Logging for the API and the chat server that stays off the event loop.
+#
+# Records go through a QueueHandler into a bounded queue that a listener thread
+# writes to stdout, so a slow or full pipe never blocks a request or a frame;
+# when the queue is full records are dropped and counted instead. A call below
+# the configured level costs one isEnabledFor check. Per-frame events are
+# DEBUG and also go through sample(), so even a DEBUG run logs a fraction.
+#
+#   log = logging.getLogger('chat')
+#   log.info("✅ Client connected", extra=fields(user=user_id))
+#   if sample(log):
+#       log.debug("📥 Received %s", message_type, extra=fields(sample_rate=LOG_SAMPLE_RATE))
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from configuration import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_RATE
+from metrics import Counter
+
+records_dropped = Counter('log_records_dropped_total', 'Log records dropped because the queue was full')
+
+listener = None
+listener_pid = None  # Forked workers start their own listener
+
+
+def fields(**values):
+    """extra= for a structured record, the values end up as key=value pairs"""
+    return {'fields': values}
+
+
+def sample(logger, level=logging.DEBUG, rate=LOG_SAMPLE_RATE):
+    """True for about rate of the calls, and only when level is enabled"""
+    return logger.isEnabledFor(level) and (rate >= 1 or random.random() < rate)
+
+
+class StructuredFormatter(logging.Formatter):
+    """time level logger message key=value..., or one JSON object per line"""
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        when = datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds')
+        values = getattr(record, 'fields', None) or {}
+        if self.as_json:
+            entry = {'time': when, 'level': record.levelname, 'logger': record.name,
+                     'message': record.getMessage(), **values}
+            if record.exc_text:
+                entry['exception'] = record.exc_text
+            return json.dumps(entry, default=str, ensure_ascii=False)
+        line = f"{when} {record.levelname:<7} {record.name} {record.getMessage()}"
+        if values:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in values.items())
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Render the traceback here, the listener only joins strings
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+
+def setup_logging(level=None):
+    """Send the root logger through the queue, once per process"""
+    global listener, listener_pid
+    if listener_pid == os.getpid():
+        if level is not None:
+            logging.getLogger().setLevel(level.upper())
+        return
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == 'json'))
+
+    root = logging.getLogger()
+    root.handlers[:] = [DroppingQueueHandler(records)]
+    root.setLevel((level or LOG_LEVEL).upper())
+
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    if listener_pid is None:
+        atexit.register(stop_logging)
+    listener_pid = os.getpid()
+
+
+def stop_logging():
+    """Write out what is still queued"""
+    global listener_pid
+    if listener is not None and listener_pid == os.getpid():
+        listener.stop()
+        listener_pid = None
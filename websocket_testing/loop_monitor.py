@@ -0,0 +1,129 @@
+# loop_monitor.py
+# Event-loop lag monitor for the API and the chat server.
+#
+# A task sleeps for LOOP_LAG_INTERVAL and measures how late it wakes up, which
+# is how long every other callback was kept waiting too. A watchdog thread
+# watches that task; when the loop has been stuck for longer than
+# LOOP_STALL_THRESHOLD it copies the loop thread's stack, so a stall report
+# names the code that was blocking (pandas, bcrypt, json.dump...) instead of
+# just saying that something did.
+#
+#   start_monitor()      # from inside the running loop, once per process
+#   monitor.stats()      # lag percentiles and the most recent stalls
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+
+from configuration import LOOP_LAG_INTERVAL, LOOP_LAG_WINDOW, LOOP_STALL_THRESHOLD, LOOP_STALLS_KEPT
+from metrics import Counter, Gauge, Histogram
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+log = logging.getLogger('loop')
+
+lag_seconds = Histogram('event_loop_lag_seconds', 'How late the event loop ran a timer', buckets=LAG_BUCKETS)
+stalls_total = Counter('event_loop_stalls_total', 'Times the event loop was blocked past the stall threshold')
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class LoopMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD, kept=LOOP_STALLS_KEPT):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=LOOP_LAG_WINDOW)  # Recent lags in seconds
+        self.stalls = deque(maxlen=kept)
+        self.stall_count = 0
+        self.lock = threading.Lock()  # Guards beat and stalled, shared with the watchdog
+        self.beat = time.monotonic()  # When the sampler last went to sleep
+        self.stalled = None           # Stall the watchdog caught and the sampler hasn't closed
+        self.loop_thread = None
+        self.task = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.task = asyncio.create_task(self.sample())
+        threading.Thread(target=self.watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                self.beat = time.monotonic()
+            due = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - due)
+            self.lags.append(lag)
+            lag_seconds.observe(lag)
+
+            with self.lock:
+                stall, self.stalled = self.stalled, None
+            if stall is not None:
+                # The watchdog saw it start, only now do we know how long it lasted
+                stall['lag_ms'] = lag * 1000
+                self.stalls.append(stall)
+                self.stall_count += 1
+                stalls_total.inc()
+                log.warning("🐢 Event loop blocked for %.0f ms\n%s", lag * 1000, stall['stack'])
+
+    def watch(self):
+        """Watchdog thread, snapshots the loop thread's stack while it is stuck"""
+        while not self.stopping.wait(self.threshold / 2):
+            with self.lock:
+                overdue = time.monotonic() - self.beat - self.interval
+                if overdue < self.threshold or self.stalled is not None:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                self.stalled = {
+                    'at': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+                    'lag_ms': overdue * 1000,  # So far, the sampler fills in the total
+                    'stack': ''.join(traceback.format_stack(frame)) if frame is not None else '',
+                }
+
+    def stats(self):
+        """Lag percentiles over the recent window and the latest stalls"""
+        lags = sorted(self.lags)
+        return {
+            'samples': len(lags),
+            'p50_ms': percentile(lags, 50) * 1000 if lags else 0.0,
+            'p90_ms': percentile(lags, 90) * 1000 if lags else 0.0,
+            'p99_ms': percentile(lags, 99) * 1000 if lags else 0.0,
+            'max_ms': lags[-1] * 1000 if lags else 0.0,
+            'stalls': self.stall_count,
+            'recent_stalls': list(self.stalls),
+        }
+
+
+monitor = None
+
+Gauge('event_loop_lag_p99_seconds', 'p99 event loop lag over the recent window',
+      function=lambda: monitor.stats()['p99_ms'] / 1000 if monitor is not None else 0.0)
+
+
+def start_monitor():
+    """Start the process-wide monitor on the running loop"""
+    global monitor
+    if monitor is None:
+        monitor = LoopMonitor()
+        monitor.start()
+    return monitor
+
+
+def stop_monitor():
+    global monitor
+    if monitor is not None:
+        monitor.stop()
+        monitor = None
@@ -6,12 +6,24 @@ from datetime import datetime, timedelta
 import jwt
 from passlib.context import CryptContext
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 import pandas as pd
 import json
 import os
+import time
+import logging
+import uuid
+from collections import OrderedDict
 
 from models import *
 from configuration import *
+from metrics import Counter, Gauge, Histogram, SIZE_BUCKETS, render as render_metrics
+from logs import fields, setup_logging
+import loop_monitor
+from profiler import ProfilerBusy, profile, render_collapsed
+from compression import CompressionMiddleware
+
+log = logging.getLogger('api')
 
 
 # In-memory fake user database
@@ -65,12 +77,15 @@ else:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
-    print("Application starting up...")
+    setup_logging()
+    loop_monitor.start_monitor()
+    log.info("Application starting up...")
     # Create data directory if it doesn't exist
     os.makedirs('./data', exist_ok=True)
     yield
     # Shutdown code
-    print("Application shutting down...")
+    log.info("Application shutting down...")
+    loop_monitor.stop_monitor()
     with open(users_db_path, 'w') as f:
         json.dump(fake_users_db, f, indent=2)
     with open(orders_db_path, 'w') as f:
@@ -78,7 +93,51 @@ async def lifespan(app: FastAPI):
     with open(fake_link_db_path, 'w') as f:
         json.dump(fake_link_db, f, indent=2)
     fake_catalog_db.to_csv(catalog_db_path, index=False)
-    print("Data saved successfully!")
+    log.info("Data saved successfully!")
+
+# Request metrics, served on /metrics
+request_duration = Histogram('http_request_duration_seconds', 'Time to serve a request', ('method', 'route'))
+requests_total = Counter('http_requests_total', 'Requests served', ('method', 'route', 'status'))
+request_errors = Counter('http_request_errors_total', 'Requests that ended in a 5xx or an exception', ('method', 'route'))
+requests_in_flight = Gauge('http_requests_in_flight', 'Requests being served')
+response_size = Histogram('http_response_size_bytes', 'Response body size', ('route',), buckets=SIZE_BUCKETS)
+
+class MetricsMiddleware:
+    """Records every HTTP request. Plain ASGI, BaseHTTPMiddleware costs far more per request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500  # Unless a response starts, the request failed
+        size = 0
+
+        async def send_and_measure(message):
+            nonlocal status_code, size
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            requests_in_flight.dec()
+            # The route template, not the raw path, so item ids don't become label values
+            route = scope.get('route')
+            labels = (scope['method'], route.path if route is not None else 'unmatched')
+            request_duration.observe(time.perf_counter() - started, labels)
+            requests_total.inc(labels + (str(status_code),))
+            response_size.observe(size, labels[1:])
+            if status_code >= 500:
+                request_errors.inc(labels)
 
 # Initialize FastAPI app
 app = FastAPI(title="Foody App API", lifespan=lifespan)
@@ -91,6 +150,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)  # Outermost, so it sees compressed sizes
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -124,32 +185,185 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
         return user_id
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
 
+def verify_admin(username: str = Depends(verify_token)):
+    if username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return username
+
+# How each ItemResponse field is computed from a catalog row (a DataFrame row,
+# or a row dict stored in an order), so a projection computes only its fields
+ITEM_FIELDS = {
+    'id': lambda row: str(row['id']),
+    'supplier': lambda row: str(row['supplier']),
+    'name': lambda row: row['name'],
+    'description': lambda row: row['description'],
+    'price': lambda row: float(row['price']),
+    'finalPrice': lambda row: round(float(row['price']) * (1 - row['discount_percent'] / 100), 2),
+    'weight': lambda row: float(row['weight']),
+    'quantity': lambda row: int(row['quantity']),
+    'category': lambda row: row['category'],
+    'unit': lambda row: row['unit'],
+    'discountPercent': lambda row: float(row['discount_percent']),
+    'minimumOrderQuantity': lambda row: int(row['min_order_qty']),
+    'stockLevel': lambda row: int(row['stock_level']),
+    'isAvailable': lambda row: bool(row['is_available']),
+    'imageUrl': lambda row: row['image_url'] if pd.notna(row['image_url']) else None,
+    'createdAt': lambda row: row['created_at'].strftime("%Y-%m-%d %H:%M:%S") if pd.notna(row['created_at']) and type(row['created_at']) != str else datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+}
+
+# Named sets of fields for ?view=, list screens only need the summary
+ITEM_VIEWS = {
+    'full': tuple(ITEM_FIELDS),
+    'summary': ('id', 'name', 'finalPrice', 'imageUrl', 'isAvailable'),
+}
+ORDER_VIEWS = {  # order fields, view of the embedded items
+    'full': (tuple(OrderResponse.model_fields), 'full'),
+    'summary': (('id', 'user_id', 'supplier_id', 'items', 'total_amount', 'status', 'created_at', 'updated_at'), 'summary'),
+}
+
 def row_to_item_response(row) -> ItemResponse:
     """Convert DataFrame row to ItemResponse"""
     if isinstance(row, ItemResponse):
         return row
-    final_price = row['price'] * (1 - row['discount_percent'] / 100)
-    return ItemResponse(
-        id=str(row['id']),
-        supplier=str(row['supplier']),
-        name=row['name'],
-        description=row['description'],
-        price=float(row['price']),
-        finalPrice=round(final_price, 2),
-        weight=float(row['weight']),
-        quantity=int(row['quantity']),
-        category=row['category'],
-        unit=row['unit'],
-        discountPercent=float(row['discount_percent']),
-        minimumOrderQuantity=int(row['min_order_qty']),
-        stockLevel=int(row['stock_level']),
-        isAvailable=bool(row['is_available']),
-        imageUrl=row['image_url'] if pd.notna(row['image_url']) else None,
-        createdAt=row['created_at'].strftime("%Y-%m-%d %H:%M:%S") if pd.notna(row['created_at']) and type(row['created_at']) != str else datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    )
+    return ItemResponse(**{name: value(row) for name, value in ITEM_FIELDS.items()})
+
+def project_item(row, fields):
+    """Just the given ItemResponse fields of a row, without building the model"""
+    if isinstance(row, ItemResponse):
+        return {name: getattr(row, name) for name in fields}
+    return {name: ITEM_FIELDS[name](row) for name in fields}
+
+def project_order(order, fields, item_fields):
+    """Just the given OrderResponse fields of an order, its items cut down to item_fields"""
+    body = {}
+    for name in fields:
+        if name == 'items':
+            body[name] = [project_item(item, item_fields) for item in order['items']]
+        elif name == 'total_amount':
+            body[name] = float(order[name])
+        else:
+            body[name] = order.get(name)
+    return body
+
+def parse_fields(fields, known):
+    """'id,name' -> ('id', 'name'), 400 for names that aren't in known"""
+    names = tuple(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in known]
+    if unknown or not names:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields requested"
+        )
+    return names
+
+def parse_view(view, views):
+    if view not in views:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown view '{view}', use one of: {', '.join(views)}"
+        )
+    return view
+
+def order_projection(view, fields, item_fields):
+    """(order fields, item fields) to send, or None for the plain full response"""
+    if view is None and fields is None and item_fields is None:
+        return None
+    order_fields, item_view = ORDER_VIEWS[parse_view(view or 'full', ORDER_VIEWS)]
+    return (parse_fields(fields, OrderResponse.model_fields) if fields else order_fields,
+            parse_fields(item_fields, ITEM_FIELDS) if item_fields else ITEM_VIEWS[item_view])
+
+def encode_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+# Catalog items rarely change, so each keeps its full field dict and the
+# encoded JSON of every view asked for so far; list responses join those
+# fragments instead of rebuilding a model per row. add_item, update_item and
+# delete_item drop the entries they touch through catalog_changed().
+item_json_cache = {}  # item id -> {None: full item dict, view name: encoded JSON}
+
+def cached_items(df):
+    """Cache entries of every row of df, in order"""
+    ids = df['id'].tolist()
+    missing = [position for position, item_id in enumerate(ids) if item_id not in item_json_cache]
+    if missing:
+        for row in df.iloc[missing].to_dict('records'):
+            item_json_cache[row['id']] = {None: project_item(row, ITEM_VIEWS['full'])}
+    return [item_json_cache[item_id] for item_id in ids]
+
+def item_fragments(df, view='full'):
+    """Encoded view of every row of df, in order"""
+    fragments = []
+    fields = ITEM_VIEWS[view]
+    for entry in cached_items(df):
+        fragment = entry.get(view)
+        if fragment is None:
+            item = entry[None]
+            fragment = entry[view] = encode_json({name: item[name] for name in fields})
+        fragments.append(fragment)
+    return fragments
+
+def items_json(df, view, fields, single=False):
+    """df as an encoded JSON array (or its first row with single), a named view or just fields"""
+    if fields:
+        fields = parse_fields(fields, ITEM_FIELDS)
+        values = [{name: entry[None][name] for name in fields} for entry in cached_items(df)]
+        return encode_json(values[0] if single else values)
+    fragments = item_fragments(df, parse_view(view, ITEM_VIEWS))
+    return fragments[0] if single else b'[' + b','.join(fragments) + b']'
+
+def items_response(df, view, fields, single=False):
+    return Response(items_json(df, view, fields, single), media_type="application/json")
+
+# Catalog change log for delta sync. Every add, update or delete bumps
+# catalog_version and moves the item to the end of catalog_changes, so the
+# changes after a client's version are a walk back from the end. Versions
+# only mean something to this process, the token carries an epoch for that.
+CATALOG_EPOCH = uuid.uuid4().hex[:12]
+catalog_version = 0
+catalog_changes = OrderedDict()  # item id -> version of its last change, oldest first
+catalog_deleted = set()          # Ids in catalog_changes whose last change was a delete
+
+def catalog_changed(item_id, deleted=False):
+    """Forget the cached JSON of an item and log the change"""
+    global catalog_version
+    item_json_cache.pop(item_id, None)
+    catalog_version += 1
+    catalog_changes[item_id] = catalog_version
+    catalog_changes.move_to_end(item_id)
+    if deleted:
+        catalog_deleted.add(item_id)
+    else:
+        catalog_deleted.discard(item_id)
+
+def reset_catalog():
+    """After fake_catalog_db was replaced wholesale: drop caches, older versions get a full sync"""
+    global CATALOG_EPOCH
+    item_json_cache.clear()
+    catalog_changes.clear()
+    catalog_deleted.clear()
+    CATALOG_EPOCH = uuid.uuid4().hex[:12]
+
+def catalog_version_token():
+    return f"{CATALOG_EPOCH}:{catalog_version}"
+
+def parse_catalog_version(token):
+    """Version number of a token issued by this process, None otherwise"""
+    epoch, _, version = str(token).partition(':')
+    if epoch != CATALOG_EPOCH or not version.isdigit() or int(version) > catalog_version:
+        return None
+    return int(version)
+
+def catalog_changed_since(version):
+    """Ids changed after version, most recently changed first"""
+    ids = []
+    for item_id in reversed(catalog_changes):
+        if catalog_changes[item_id] <= version:
+            break
+        ids.append(item_id)
+    return ids
 
 
 # API Endpoints
@@ -157,9 +371,7 @@ def row_to_item_response(row) -> ItemResponse:
 async def login(request: LoginRequest):
     """Login endpoint - authenticates user and returns JWT token"""
     user = fake_users_db.get(request.username)
-
-    print(request.username)
-    print(fake_users_db.values())
+    log.debug("Login attempt", extra=fields(username=request.username))
 
     if not user:
         raise HTTPException(
@@ -266,6 +478,8 @@ async def get_items(
     search: Optional[str] = Query(None, description="Search in name and description"),
     category: Optional[str] = Query(None, description="Filter by category"),
     sort: Optional[str] = Query(None, description="Sort by: name_asc, name_desc, price_asc, price_desc"),
+    view: str = Query('full', description="full or summary (id, name, finalPrice, imageUrl, isAvailable)"),
+    fields: Optional[str] = Query(None, description="Comma-separated item fields to return, overrides view"),
 ):
     """Get all items with optional filters"""
     global fake_catalog_db
@@ -323,9 +537,10 @@ async def get_items(
         elif sort == 'price_desc':
             filtered_df = filtered_df.sort_values('price', ascending=False)
 
-    # Convert to list of ItemResponse
-    items = [row_to_item_response(row) for _, row in filtered_df.iterrows()]
-    return items
+    response = items_response(filtered_df, view, fields)
+    # Where /api/catalog/changes/ can pick up from
+    response.headers['X-Catalog-Version'] = catalog_version_token()
+    return response
 
 @app.post("/api/items/", response_model=ConfirmationResponse, status_code=status.HTTP_201_CREATED)
 async def add_item(
@@ -376,6 +591,8 @@ async def add_item(
         pd.DataFrame([new_item])
     ], ignore_index=True)
 
+    catalog_changed(item_id)
+
     # Save immediately
     fake_catalog_db.to_csv(catalog_db_path, index=False)
 
@@ -384,13 +601,47 @@ async def add_item(
         message='Item has been added successfuly'
     )
 
+@app.get("/api/catalog/changes/")
+async def get_catalog_changes(
+    user_id: str, # = Depends(verify_token),
+    since: Optional[str] = Query(None, description="version from a previous call or X-Catalog-Version"),
+    view: str = Query('full', description="full or summary (id, name, finalPrice, imageUrl, isAvailable)"),
+    fields: Optional[str] = Query(None, description="Comma-separated item fields to return, overrides view"),
+):
+    """Items added, updated or deleted since a catalog version, for clients keeping a local copy.
+
+    full is true when since is missing or from another server run, items is
+    then the whole catalog and the client should replace its copy.
+    """
+    if not any(u['id'] == user_id for u in fake_users_db.values()):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only users can see items"
+        )
+
+    version = parse_catalog_version(since) if since is not None else None
+    if version is None:
+        changed = fake_catalog_db
+        deleted = []
+    else:
+        ids = catalog_changed_since(version)
+        deleted = [item_id for item_id in ids if item_id in catalog_deleted]
+        changed = fake_catalog_db[fake_catalog_db['id'].isin(ids)]
+
+    body = b''.join([
+        b'{"version":', encode_json(catalog_version_token()),
+        b',"full":', b'true' if version is None else b'false',
+        b',"items":', items_json(changed, view, fields),
+        b',"deleted":', encode_json(deleted),
+        b'}',
+    ])
+    return Response(body, media_type="application/json")
+
 @app.get("/api/categories/{user_id}", response_model=List[CategoryResponse])
 async def get_categories(user_id: str): # = Depends(verify_token)):
     """Get all categories with item counts"""
     global fake_catalog_db
 
-    print(user_id)
-
     if fake_catalog_db.empty:
         return []
 
@@ -419,6 +670,8 @@ async def get_categories(user_id: str): # = Depends(verify_token)):
 @app.get("/api/items/{item_id}", response_model=ItemResponse)
 async def get_item_by_id(
     item_id: str,
+    view: str = Query('full', description="full or summary (id, name, finalPrice, imageUrl, isAvailable)"),
+    fields: Optional[str] = Query(None, description="Comma-separated item fields to return, overrides view"),
     # user_id: str, # = Depends(verify_token)
 ):
     """Get a specific item by ID"""
@@ -451,12 +704,12 @@ async def get_item_by_id(
             detail=f"Item with id '{item_id}' not found"
         )
 
-    # Convert to ItemResponse
-    return row_to_item_response(item_row.iloc[0])
+    return items_response(item_row, view, fields, single=True)
 
 @app.put("/api/items/{item_id}", response_model=ItemResponse)
 async def update_item(
     item_id: str,
+    request: ItemRequest,
     user_id: str, # = Depends(verify_token)
 ):
     """Update an existing item (supplier only, own items only)"""
@@ -509,6 +762,7 @@ async def update_item(
     fake_catalog_db.loc[item_idx[0], 'stock_level'] = request.stockLevel
     fake_catalog_db.loc[item_idx[0], 'is_available'] = request.isAvailable
     fake_catalog_db.loc[item_idx[0], 'image_url'] = request.imageUrl
+    catalog_changed(item_id)
 
     # Save immediately
     fake_catalog_db.to_csv(catalog_db_path, index=False)
@@ -560,6 +814,7 @@ async def delete_item(
 
     # Delete item
     fake_catalog_db = fake_catalog_db.drop(item_idx)
+    catalog_changed(item_id, deleted=True)
 
     # Save immediately
     fake_catalog_db.to_csv(catalog_db_path, index=False)
@@ -627,9 +882,7 @@ async def create_order(
 
     fake_orders_db[order_id] = new_order
 
-    # Save immediately
-    print(order_id)
-    print(fake_orders_db[order_id])
+    log.info("Order created", extra=fields(order=order_id, items=len(new_order['items'])))
 
     return OrderResponse(**new_order)
 
@@ -637,10 +890,14 @@ async def create_order(
 @app.get("/api/orders/{user_id}", response_model=OrdersResponse)
 async def get_user_orders(
     user_id: str, # = Depends(verify_token),
-    status_filter: Optional[str] = Query(None, description="Filter by order status")
+    status_filter: Optional[str] = Query(None, description="Filter by order status"),
+    view: Optional[str] = Query(None, description="full or summary (no address or notes, summary items)"),
+    fields: Optional[str] = Query(None, description="Comma-separated order fields to return, overrides view"),
+    item_fields: Optional[str] = Query(None, description="Comma-separated fields of the embedded items"),
 ):
     """Get all orders for a specific user"""
     global fake_orders_db
+    projection = order_projection(view, fields, item_fields)
 
     # Get user info
     user = None
@@ -664,24 +921,30 @@ async def get_user_orders(
         )
 
     # Filter orders
-    user_orders = []
+    matching = []
     for order in fake_orders_db.values():
         # For customers: show their orders
         # For suppliers: show orders placed with them
         if user['userType'] == 'consumer':
             if order['user_id'] == user_id:
                 if status_filter is None or order['status'] == status_filter:
-                    order['items'] = [row_to_item_response(item) for item in order['items']]
-                    user_orders.append(OrderResponse(**order))
+                    matching.append(order)
         elif user['userType'] == 'supplier':
             if order['supplier_id'] == user['id']:
                 if status_filter is None or order['status'] == status_filter:
-                    order['items'] = [row_to_item_response(item) for item in order['items']]
-                    print(order['created_at'])
-                    user_orders.append(OrderResponse(**order))
+                    matching.append(order)
 
     # Sort by created_at descending (newest first)
-    user_orders.sort(key=lambda x: x.created_at, reverse=True)
+    matching.sort(key=lambda order: order['created_at'], reverse=True)
+
+    if projection is not None:
+        return Response(encode_json({'orders': [project_order(order, *projection) for order in matching]}),
+                        media_type="application/json")
+
+    user_orders = []
+    for order in matching:
+        order['items'] = [row_to_item_response(item) for item in order['items']]
+        user_orders.append(OrderResponse(**order))
 
     return OrdersResponse(
         orders=user_orders
@@ -691,9 +954,13 @@ async def get_user_orders(
 async def get_order_by_id(
     order_id: str,
     # user_id: str, # = Depends(verify_token)
+    view: Optional[str] = Query(None, description="full or summary (no address or notes, summary items)"),
+    fields: Optional[str] = Query(None, description="Comma-separated order fields to return, overrides view"),
+    item_fields: Optional[str] = Query(None, description="Comma-separated fields of the embedded items"),
 ):
     """Get a specific order by ID"""
     global fake_orders_db
+    projection = order_projection(view, fields, item_fields)
 
     # Get user info
     # user = None
@@ -730,7 +997,9 @@ async def get_order_by_id(
     #         detail="Cannot view orders from other suppliers"
     #     )
 
-    print(order)
+    if projection is not None:
+        return Response(encode_json(project_order(order, *projection)), media_type="application/json")
+
     order['items'] = [row_to_item_response(item) for item in order['items']]
     return OrderResponse(**order)
 
@@ -819,10 +1088,14 @@ async def update_order_status(
 @app.get("/api/supplier/orders/", response_model=List[OrderResponse])
 async def get_supplier_orders(
     user_id: str, # = Depends(verify_token),
-    status_filter: Optional[str] = Query(None, description="Filter by order status")
+    status_filter: Optional[str] = Query(None, description="Filter by order status"),
+    view: Optional[str] = Query(None, description="full or summary (no address or notes, summary items)"),
+    fields: Optional[str] = Query(None, description="Comma-separated order fields to return, overrides view"),
+    item_fields: Optional[str] = Query(None, description="Comma-separated fields of the embedded items"),
 ):
     """Get all orders for the authenticated supplier"""
     global fake_orders_db
+    projection = order_projection(view, fields, item_fields)
 
     # Get user info
     user = None
@@ -844,16 +1117,47 @@ async def get_supplier_orders(
         )
 
     # Filter orders for this supplier
-    supplier_orders = []
+    matching = []
     for order in fake_orders_db.values():
         if order['supplier_id'] == user['id']:
             if status_filter is None or order['status'] == status_filter:
-                supplier_orders.append(OrderResponse(**order))
+                matching.append(order)
 
     # Sort by created_at descending (newest first)
-    supplier_orders.sort(key=lambda x: x.created_at, reverse=True)
+    matching.sort(key=lambda order: order['created_at'], reverse=True)
+
+    if projection is not None:
+        return Response(encode_json([project_order(order, *projection) for order in matching]),
+                        media_type="application/json")
+
+    return [OrderResponse(**order) for order in matching]
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
-    return supplier_orders
+@app.get("/stats", include_in_schema=False)
+async def stats():
+    """Event loop lag percentiles and stack snapshots of recent stalls"""
+    monitor = loop_monitor.monitor
+    return {
+        'requests_in_flight': requests_in_flight.values.get((), 0),
+        'loop_lag': monitor.stats() if monitor is not None else None,
+    }
+
+@app.get("/admin/profile", include_in_schema=False)
+async def admin_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    admin: str = Depends(verify_admin)
+):
+    """Sample the event loop for a while, collapsed stacks for flamegraph.pl or speedscope"""
+    try:
+        stacks = await profile(seconds)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    log.info("Profile taken", extra=fields(admin=admin, seconds=seconds, samples=sum(stacks.values())))
+    return PlainTextResponse(render_collapsed(stacks))
 
 @app.get("/")
 async def root():
@@ -871,4 +1175,5 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvicorn's own loggers, the access log included, go through our queue too
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_config=None)
\ No newline at end of file
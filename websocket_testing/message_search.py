@@ -0,0 +1,95 @@
+# message_search.py
+# Inverted index over chat message text for search_messages
+import re
+from array import array
+from bisect import bisect_left, insort
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.casefold())
+
+
+class MessageIndex:
+    """Maps every word to the messages containing it, updated as messages arrive.
+
+    Each indexed message gets a document number in arrival order. Postings are
+    kept per word and dialogue as arrays of document numbers, so a search scoped
+    to one dialogue never looks at the others. The sorted vocabulary answers
+    prefix queries with a bisect.
+    """
+
+    def __init__(self):
+        self.postings = {}            # word -> {dialogue_id: array of doc numbers}
+        self.vocabulary = []          # Sorted words, for prefix lookups
+        self.doc_dialogue = []        # doc number -> dialogue id
+        self.doc_seq = array('I')     # doc number -> message seq within the dialogue
+
+    def __len__(self):
+        return len(self.doc_dialogue)
+
+    def add(self, dialogue_id, seq, text):
+        """Index one message, messages must be added in the order they arrive.
+
+        dialogue_id should be the message's own, which ChatMessage already
+        interned, so the doc list shares one string per dialogue.
+        """
+        words = set(tokenize(text))  # Before any change, so bad text leaves the index as it was
+        doc = len(self.doc_dialogue)
+        self.doc_dialogue.append(dialogue_id)
+        self.doc_seq.append(seq)
+        for word in words:
+            by_dialogue = self.postings.get(word)
+            if by_dialogue is None:
+                by_dialogue = self.postings[word] = {}
+                insort(self.vocabulary, word)
+            docs = by_dialogue.get(dialogue_id)
+            if docs is None:
+                docs = by_dialogue[dialogue_id] = array('I')
+            docs.append(doc)
+
+    def expand(self, prefix):
+        """Indexed words starting with prefix"""
+        i = bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            yield self.vocabulary[i]
+            i += 1
+
+    def matching(self, term, dialogue_id=None):
+        """Doc numbers of messages with a word starting with term"""
+        docs = set()
+        for word in self.expand(term):
+            by_dialogue = self.postings[word]
+            if dialogue_id is None:
+                for dialogue_docs in by_dialogue.values():
+                    docs.update(dialogue_docs)
+            elif dialogue_id in by_dialogue:
+                docs.update(by_dialogue[dialogue_id])
+        return docs
+
+    def search(self, query, dialogue_id=None, limit=20, before=None):
+        """Messages containing every query term as a word prefix, newest first.
+
+        Returns (hits, total, next_cursor) where hits are (dialogue_id, seq)
+        pairs. Pass next_cursor back as before to get the following page.
+        """
+        if limit < 1:
+            raise ValueError(f"Invalid limit: {limit!r}")
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)  # Longest terms match least
+        if not terms:
+            return [], 0, None
+        docs = None
+        for term in terms:
+            matches = self.matching(term, dialogue_id)
+            docs = matches if docs is None else docs & matches
+            if not docs:
+                return [], 0, None
+
+        total = len(docs)
+        if before is not None:
+            docs = [doc for doc in docs if doc < before]
+        ordered = sorted(docs, reverse=True)
+        page = ordered[:limit]
+        next_cursor = page[-1] if len(ordered) > limit else None
+        return [(self.doc_dialogue[doc], self.doc_seq[doc]) for doc in page], total, next_cursor
@@ -0,0 +1,261 @@
+# replay_traffic.py
+# Play traffic captured with `server.py --record` against a running server and
+# report throughput and reply latency per message type.
+#
+#   python server.py --record traffic.jsonl.gz              # capture
+#   python replay_traffic.py traffic.jsonl.gz               # replay at 1x
+#   python replay_traffic.py traffic.jsonl.gz --speed 10    # 10x faster
+#   python replay_traffic.py traffic.jsonl.gz --speed max   # as fast as possible
+#   python replay_traffic.py traffic.jsonl.worker*.gz --json out.json
+#
+# Start the server fresh before a replay: dialogue ids in the capture refer to
+# the state of the recorded server.
+#
+# Faster replays squeeze each connection's frames together, and the server's
+# per-connection limit (RATE_LIMIT_FRAMES_PER_SECOND, RATE_LIMIT_BURST) starts
+# dropping them, so the numbers describe the limiter instead of the server.
+# Throttled frames are counted in the report. Give the server room first:
+#
+#   python server.py --rate-limit 0                         # limit off
+#   python server.py --rate-limit 200                       # or 10x the default
+#
+# Captures also hold the frames the recording server dropped as throttled and
+# the ones that didn't decode ('invalid', kept raw). Both are sent again by
+# default, so a misbehaving client is reproduced; --skip leaves them out.
+#
+#   python replay_traffic.py traffic.jsonl.gz --skip throttled --skip invalid
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import websockets
+
+from configuration import *
+from traffic_capture import frame_from_raw, read_capture
+
+# Reply types answering each request type. Broadcast replies (new_dialogue,
+# mark_read_success to other devices) are matched to the oldest open request,
+# so their latency is approximate.
+ANSWERED_BY = {
+    'get_dialogues': ('initial_dialogues', 'dialogues_page', 'dialogues_changed'),
+    'get_messages': ('message_history',),
+    'send_message': ('message_sent',),
+    'mark_read': ('mark_read_success',),
+    'create_dialogue': ('new_dialogue',),
+    'ping': ('pong',),
+    'search_messages': ('search_results',),
+    'resume': ('resumed', 'resync_required'),
+}
+REQUEST_FOR = {reply: request for request, replies in ANSWERED_BY.items() for reply in replies}
+
+
+def token_for(user_id):
+    payload = {'sub': user_id, 'exp': datetime.now(timezone.utc) + timedelta(hours=1)}
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+
+class ReplayConnection:
+    """One recorded connection, replayed in order on its own websocket"""
+
+    def __init__(self, name, url, stats):
+        self.name = name
+        self.url = url
+        self.stats = stats
+        self.events = asyncio.Queue()
+        self.pending = {request: deque() for request in ANSWERED_BY}  # send times
+        self.pending_sends = {}  # tempId -> send time
+        self.temp_ids = 0
+
+    def open_requests(self):
+        return sum(len(q) for q in self.pending.values()) + len(self.pending_sends)
+
+    async def run(self):
+        websocket = None
+        try:
+            while True:
+                kind, payload, marker = await self.events.get()
+                if kind == 'open':
+                    url = self.url
+                    params = []
+                    if payload.get('userId') is not None:
+                        params.append(f"token={token_for(payload['userId'])}")
+                    if payload.get('batch'):
+                        params.append('batch=1')
+                    if params:
+                        url += '?' + '&'.join(params)
+                    try:
+                        websocket = await websockets.connect(url, max_size=None)
+                    except (OSError, websockets.exceptions.InvalidHandshake) as e:
+                        self.stats['failed_connections'] += 1
+                        print(f"❌ Connection {self.name} failed: {e}")
+                        return
+                    receiver = asyncio.create_task(self.receive(websocket))
+                elif kind == 'frame' and marker == 'invalid':
+                    await websocket.send(frame_from_raw(payload))
+                    self.stats['sent']['(invalid)'] = self.stats['sent'].get('(invalid)', 0) + 1
+                elif kind == 'frame':
+                    await self.send(websocket, payload)
+                elif kind == 'close':
+                    await self.drain()
+                    receiver.cancel()
+                    await websocket.close()
+                    return
+        except websockets.exceptions.ConnectionClosed:
+            self.stats['dropped_connections'] += 1
+
+    async def send(self, websocket, frame):
+        request = frame.get('type')
+        frame = dict(frame)
+        now = time.perf_counter()
+        if request == 'send_message':
+            # Recorded tempIds may repeat across connections, make them unique
+            self.temp_ids += 1
+            frame['tempId'] = f"{self.name}-{self.temp_ids}"
+            self.pending_sends[frame['tempId']] = now
+        elif request in self.pending:
+            self.pending[request].append(now)
+        await websocket.send(json.dumps(frame))
+        self.stats['sent'][request] = self.stats['sent'].get(request, 0) + 1
+
+    async def receive(self, websocket):
+        async for raw in websocket:
+            now = time.perf_counter()
+            data = json.loads(raw)
+            for message in data if isinstance(data, list) else [data]:
+                self.answer(message, now)
+
+    def answer(self, message, now):
+        reply = message.get('type')
+        if reply == 'error':
+            self.stats['errors'] += 1
+            if message.get('message') == 'Rate limit exceeded':
+                self.stats['throttled'] += 1
+            return
+        if reply == 'message_sent':
+            started = self.pending_sends.pop(message.get('tempId'), None)
+            request = 'send_message'
+        elif reply in REQUEST_FOR:
+            request = REQUEST_FOR[reply]
+            queue = self.pending[request]
+            started = queue.popleft() if queue else None
+        else:
+            return
+        if started is not None:
+            self.stats['latencies'].setdefault(request, []).append(now - started)
+
+    async def drain(self, timeout=5.0):
+        """Wait a little for replies to requests still in flight"""
+        deadline = time.perf_counter() + timeout
+        while self.open_requests() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def replay(events, url, speed, skip=()):
+    """Schedule the capture, speed is a multiplier or None for as fast as possible.
+
+    skip holds the frame markers ('throttled', 'invalid') to leave out.
+    """
+    stats = {'sent': {}, 'latencies': {}, 'errors': 0, 'throttled': 0, 'skipped_frames': 0,
+             'failed_connections': 0, 'dropped_connections': 0}
+    connections = {}
+    tasks = []
+    first = events[0][0]
+    started = time.perf_counter()
+
+    for at, name, kind, payload, *marker in events:
+        marker = marker[0] if marker else None
+        if speed is not None:
+            delay = (at - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == 'open':
+            connection = connections[name] = ReplayConnection(name, url, stats)
+            tasks.append(asyncio.create_task(connection.run()))
+        elif name not in connections:
+            continue  # Opened before the capture started
+        if kind == 'frame' and (marker in skip or not isinstance(payload, dict)):
+            stats['skipped_frames'] += 1  # Asked to, or recorded but not a request we can time
+            continue
+        connections[name].events.put_nowait((kind, payload, marker))
+
+    # Connections still open when the capture ended
+    for connection in connections.values():
+        connection.events.put_nowait(('close', None, None))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    sent = sum(stats['sent'].values())
+    results = {
+        'frames': sent,
+        'connections': len(connections),
+        'seconds': elapsed,
+        'frames_per_second': sent / elapsed if elapsed else 0.0,
+        'errors': stats['errors'],
+        'throttled': stats['throttled'],
+        'skipped_frames': stats['skipped_frames'],
+        'failed_connections': stats['failed_connections'],
+        'dropped_connections': stats['dropped_connections'],
+        'types': {},
+    }
+    for request, count in sorted(stats['sent'].items(), key=lambda item: str(item[0])):
+        latencies = sorted(stats['latencies'].get(request, []))
+        row = {'sent': count, 'answered': len(latencies)}
+        if latencies:
+            row.update({
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p90_ms': percentile(latencies, 90) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            })
+        results['types'][str(request)] = row
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured chat traffic')
+    parser.add_argument('captures', nargs='+', help='files written by server.py --record')
+    parser.add_argument('--url', default='ws://localhost:8080/ws')
+    parser.add_argument('--speed', default='1', help="time multiplier, e.g. 1 or 10, or 'max'")
+    parser.add_argument('--skip', action='append', default=[], choices=['throttled', 'invalid'],
+                        help="leave out frames the recording server throttled or couldn't decode")
+    parser.add_argument('--json', dest='json_path', help='also write results to this file')
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    events = read_capture(args.captures)
+    if not events:
+        parser.error('the capture is empty')
+    print(f"▶️  Replaying {len(events)} events at {args.speed}x against {args.url}")
+
+    results = asyncio.run(replay(events, args.url, speed, args.skip))
+
+    print(f"\n{'type':<18} {'sent':>7} {'answered':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    print("-" * 72)
+    for request, row in results['types'].items():
+        timings = ''.join(f"{row.get(key, float('nan')):>9.2f}" for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        print(f"{request:<18} {row['sent']:>7} {row['answered']:>9}{timings}")
+    print("-" * 72)
+    print(f"📊 {results['frames']} frames from {results['connections']} connections in "
+          f"{results['seconds']:.2f}s ({results['frames_per_second']:.0f} frames/s), "
+          f"{results['errors']} errors, {results['failed_connections']} failed connections")
+    if results['skipped_frames']:
+        print(f"⏭️  Skipped {results['skipped_frames']} recorded frames (--skip, or not JSON objects)")
+    if results['throttled']:
+        print(f"⚠️  The server throttled {results['throttled']} times, the latencies above include "
+              f"its rate limit. Restart it with --rate-limit 0 to measure the server itself")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'captures': args.captures, 'speed': args.speed, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
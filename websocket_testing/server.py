@@ -1,12 +1,43 @@
 # server.py
 import asyncio
 import websockets
-import json
 from datetime import datetime, timedelta
 import random
 import sys
+import argparse
+import itertools
+import multiprocessing
+import zlib
+import uuid
+import json
+import os
+import weakref
+import time
+import logging
+import re
+from collections import deque, Counter
+from http import HTTPStatus
+import jwt
+from urllib.parse import urlparse, parse_qs
+
+from configuration import *
+from chat_protocol import *
+from broker import BrokerClient, run_broker
+from chat_history import ChatMessage, DialogueHistory, remove_spill_files
+from dialogue_index import DialogueIndex
+from message_search import MessageIndex
+from traffic_capture import TrafficRecorder, raw_frame, worker_capture_path
+from metrics import Counter as MetricCounter, Gauge, Histogram, render as render_metrics
+from logs import fields, sample, setup_logging, stop_logging
+import loop_monitor
+from profiler import ProfilerBusy, profile, render_collapsed, top_functions
+
+log = logging.getLogger('chat')
+# Our connect and disconnect records replace the library's per-connection ones
+logging.getLogger('websockets.server').setLevel(logging.WARNING)
 
 connected_clients = set()
+client_state = {}  # websocket -> per-connection options and outbox
 
 # Mock data for dialogues
 MOCK_DIALOGUES = [
@@ -15,7 +46,6 @@ MOCK_DIALOGUES = [
         'contactName': 'John Doe',
         'lastMessage': 'Hey, are you free for lunch?',
         'timestamp': (datetime.now() - timedelta(minutes=5)).isoformat(),
-        'unreadCount': 2,
         'avatarUrl': 'https://i.pravatar.cc/150?img=1',
         'isOnline': True
     },
@@ -24,7 +54,6 @@ MOCK_DIALOGUES = [
         'contactName': 'Sarah Smith',
         'lastMessage': 'Thanks for the help!',
         'timestamp': (datetime.now() - timedelta(hours=1)).isoformat(),
-        'unreadCount': 0,
         'avatarUrl': 'https://i.pravatar.cc/150?img=2',
         'isOnline': True
     },
@@ -33,7 +62,6 @@ MOCK_DIALOGUES = [
         'contactName': 'Mike Johnson',
         'lastMessage': 'See you tomorrow 👋',
         'timestamp': (datetime.now() - timedelta(hours=3)).isoformat(),
-        'unreadCount': 1,
         'avatarUrl': 'https://i.pravatar.cc/150?img=3',
         'isOnline': False
     },
@@ -42,7 +70,6 @@ MOCK_DIALOGUES = [
         'contactName': 'Emily Brown',
         'lastMessage': 'The project looks great!',
         'timestamp': (datetime.now() - timedelta(days=1)).isoformat(),
-        'unreadCount': 0,
         'avatarUrl': 'https://i.pravatar.cc/150?img=4',
         'isOnline': False
     },
@@ -51,7 +78,6 @@ MOCK_DIALOGUES = [
         'contactName': 'Alex Wilson',
         'lastMessage': 'Can you send me the files?',
         'timestamp': (datetime.now() - timedelta(days=2)).isoformat(),
-        'unreadCount': 5,
         'avatarUrl': 'https://i.pravatar.cc/150?img=5',
         'isOnline': True
     }
@@ -181,161 +207,1030 @@ MOCK_MESSAGES = {
 
 # Store dialogues and messages in memory
 dialogues = {d['id']: d for d in MOCK_DIALOGUES}
-messages = {k: list(v) for k, v in MOCK_MESSAGES.items()}  # Deep copy
+messages = {}  # dialogue_id -> DialogueHistory, seeded from MOCK_MESSAGES below
+dialogue_index = DialogueIndex()  # Dialogue ids by last activity, newest first
+search_index = MessageIndex()  # Words of every message, for search_messages
 message_counter = 100  # For generating new message IDs
 
+# Read state. Every message gets a per-dialogue sequence number and each reader
+# keeps a last-read watermark, so unread counts and isRead are derived instead
+# of being rewritten message by message.
+READERS = ('me', 'contact')
+dialogue_seq = {}     # dialogue_id -> last assigned message seq
+authored_counts = {}  # dialogue_id -> {author: messages written so far}
+read_marks = {}       # dialogue_id -> {reader: {'seq': ..., 'authored': ...}}
+
+def message_author(msg):
+    return 'me' if msg.is_me else 'contact'
+
+def other_side(side):
+    return 'contact' if side == 'me' else 'me'
+
+def init_read_state(dialogue_id):
+    """Create empty read state for a dialogue if it has none yet"""
+    dialogue_seq.setdefault(dialogue_id, 0)
+    authored_counts.setdefault(dialogue_id, {side: 0 for side in READERS})
+    read_marks.setdefault(dialogue_id, {
+        reader: {'seq': 0, 'authored': 0} for reader in READERS
+    })
+
+def mark_dialogue_read(dialogue_id, reader='me'):
+    """Move the reader's watermark to the newest message of the dialogue"""
+    init_read_state(dialogue_id)
+    read_marks[dialogue_id][reader] = {
+        'seq': dialogue_seq[dialogue_id],
+        'authored': authored_counts[dialogue_id][other_side(reader)],
+    }
+
+def unread_count(dialogue_id, reader='me'):
+    """Messages from the other side written after the reader's watermark"""
+    if dialogue_id not in read_marks:
+        return 0
+    written = authored_counts[dialogue_id][other_side(reader)]
+    return written - read_marks[dialogue_id][reader]['authored']
+
+def is_message_read(msg):
+    """A message is read once the other side's watermark has passed it"""
+    marks = read_marks.get(msg.dialogue_id)
+    if marks is None:
+        return False
+    return msg.seq <= marks[other_side(message_author(msg))]['seq']
+
+def apply_message(msg):
+    """Append a numbered message to its dialogue and update read state"""
+    dialogue_id = msg.dialogue_id
+    init_read_state(dialogue_id)
+
+    # Indexed first, it is the step that can reject a message, before anything else changed
+    search_index.add(dialogue_id, msg.seq, msg.text)
+    dialogue_seq[dialogue_id] = msg.seq
+    if dialogue_id not in messages:
+        messages[dialogue_id] = DialogueHistory(dialogue_id)
+    messages[dialogue_id].append(msg)
+    authored_counts[dialogue_id][message_author(msg)] += 1
+
+    # Update dialogue last message
+    if dialogue_id in dialogues:
+        dialogues[dialogue_id]['lastMessage'] = msg.text
+        dialogues[dialogue_id]['timestamp'] = msg.timestamp
+        dialogue_index.update(dialogue_id, msg.sent_at)
+
+def store_message(dialogue_id, text, is_me):
+    """Create a message, append it to the dialogue and update read state"""
+    global message_counter
+    init_read_state(dialogue_id)
+    message_counter += 1
+
+    new_message = ChatMessage(
+        dialogue_id, dialogue_seq[dialogue_id] + 1, message_counter, text, is_me, time.time()
+    )
+    apply_message(new_message)
+    return new_message
+
+def message_to_wire(msg):
+    return {**msg.to_dict(), 'isRead': is_message_read(msg)}
+
+def dialogue_to_wire(dialogue):
+    return {**dialogue, 'unreadCount': unread_count(dialogue['id'])}
+
+def dialogue_activity(dialogue):
+    return datetime.fromisoformat(dialogue['timestamp']).timestamp()
+
+def dialogues_by_activity(ids=None):
+    """Wire dialogues, most recently active first unless ids gives the order"""
+    return [dialogue_to_wire(dialogues[d]) for d in (dialogue_index if ids is None else ids)]
+
+def dialogue_version():
+    """Token for updatedSince. Versions are per process, so it names the process too"""
+    return f"{SERVER_EPOCH}:{WORKER_ID}:{dialogue_index.version}"
+
+DIALOGUE_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+def parse_dialogue_id(value):
+    """Dialogue id sent by a client as the string used everywhere here, None if it isn't one"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        value = str(value)
+    # Ids end up in message ids, logs and spill files, so no separators or control characters
+    if isinstance(value, str) and DIALOGUE_ID_RE.fullmatch(value):
+        return value
+    return None
+
+def parse_dialogue_version(token):
+    """Version number of a token issued by this process, None otherwise"""
+    epoch, _, rest = str(token).partition(':')
+    worker, _, version = rest.partition(':')
+    if epoch != SERVER_EPOCH or worker != str(WORKER_ID) or not version.isdigit():
+        return None
+    return int(version)
+
+# Seed messages, sequence numbers and watermarks from the mock isRead flags
+for _dialogue_id, _history in MOCK_MESSAGES.items():
+    init_read_state(_dialogue_id)
+    messages[_dialogue_id] = DialogueHistory(_dialogue_id)
+    for _data in _history:
+        dialogue_seq[_dialogue_id] += 1
+        _msg = ChatMessage.from_dict(_data, dialogue_seq[_dialogue_id])
+        messages[_dialogue_id].append(_msg)
+        search_index.add(_msg.dialogue_id, _msg.seq, _msg.text)
+        _author = message_author(_msg)
+        authored_counts[_dialogue_id][_author] += 1
+        if _data['isRead']:
+            read_marks[_dialogue_id][other_side(_author)] = {
+                'seq': _msg.seq,
+                'authored': authored_counts[_dialogue_id][_author],
+            }
+for _dialogue_id in dialogues:
+    init_read_state(_dialogue_id)
+    dialogue_index.update(_dialogue_id, dialogue_activity(dialogues[_dialogue_id]))
+
+def query_params(path):
+    query = urlparse(path).query
+    return {key: values[-1] for key, values in parse_qs(query).items()}
+
+def connection_params(websocket):
+    """Query parameters of the handshake, e.g. ws://host:8080/ws?batch=1"""
+    return query_params(websocket.request.path)
+
+# Authentication. Clients present the JWT issued by main.py, either as an
+# "Authorization: Bearer" header or as ?token= (browsers can't set headers).
+users_db_path = './data/users_db.json'
+if os.path.exists(users_db_path):
+    with open(users_db_path, 'r') as f:
+        user_ids_by_username = {u['username']: u['id'] for u in json.load(f).values()}
+else:
+    user_ids_by_username = {}
+
+handshake_users = weakref.WeakKeyDictionary()  # connection -> user_id until handle_client
+user_connections = {}  # user_id -> set of that user's websockets
+
+def authenticate(token):
+    """User id for a token issued by main.py, None if it isn't valid"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    subject = payload.get('sub')
+    if subject is None:
+        return None
+    # Login puts the username in sub, registration puts the user id
+    return user_ids_by_username.get(subject, subject)
+
+# Admission control and rate limiting
+admission_counters = Counter()  # 'rejected_full', 'rejected_auth', 'throttled_frames'
+open_connections = 0  # Admitted at the handshake and not closed yet, what MAX_CONNECTIONS caps
+closing_waits = set()  # Tasks waiting for an admitted connection to close
+
+def admit(connection):
+    """Count a connection from its handshake until it closes, however it ends"""
+    global open_connections
+    open_connections += 1
+    task = asyncio.create_task(connection.wait_closed())
+    closing_waits.add(task)
+    task.add_done_callback(release_connection)
+
+def release_connection(task):
+    global open_connections
+    closing_waits.discard(task)
+    open_connections -= 1
+
+def take_token(state):
+    """Token bucket per connection, False when the frame should be dropped"""
+    if not RATE_LIMIT_FRAMES_PER_SECOND:
+        return True  # Turned off with --rate-limit 0
+    now = time.monotonic()
+    state['tokens'] = min(
+        RATE_LIMIT_BURST,
+        state['tokens'] + (now - state['refilled_at']) * RATE_LIMIT_FRAMES_PER_SECOND
+    )
+    state['refilled_at'] = now
+    if state['tokens'] < 1:
+        return False
+    state['tokens'] -= 1
+    return True
+
+def server_stats():
+    """Connection counters and event loop lag of this process, served on /stats"""
+    monitor = loop_monitor.monitor
+    return {
+        'worker': WORKER_ID,
+        'connected_clients': len(connected_clients),
+        'open_connections': open_connections,
+        'users': len(user_connections),
+        'reaped': dict(reaped_connections),
+        **admission_counters,
+        'loop_lag': monitor.stats() if monitor is not None else None,
+    }
+
+def process_request(connection, request):
+    """Reject the handshake when the server is full or the token isn't valid"""
+    if urlparse(request.path).path == '/metrics':
+        # Plain HTTP scrape, each worker reports its own numbers
+        response = connection.respond(HTTPStatus.OK, render_metrics())
+        del response.headers['Content-Type']
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+    if urlparse(request.path).path == '/stats':
+        response = connection.respond(HTTPStatus.OK, json.dumps(server_stats()))
+        del response.headers['Content-Type']
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    # Handshakes still in progress count too, a burst of them can't overshoot
+    if open_connections >= MAX_CONNECTIONS:
+        admission_counters['rejected_full'] += 1
+        return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Server is full, retry later\n")
+
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    else:
+        token = query_params(request.path).get('token')
+
+    if token is None:
+        if WS_ALLOW_ANONYMOUS:
+            admit(connection)
+            return None
+        admission_counters['rejected_auth'] += 1
+        return connection.respond(HTTPStatus.UNAUTHORIZED, "Missing token\n")
+
+    user_id = authenticate(token)
+    if user_id is None:
+        admission_counters['rejected_auth'] += 1
+        return connection.respond(HTTPStatus.UNAUTHORIZED, "Invalid or expired token\n")
+    handshake_users[connection] = user_id
+    admit(connection)
+    return None
+
+async def send_to_user(user_id, message_type, data):
+    """Deliver a recorded event to every connection of one user on this process"""
+    devices = user_connections.get(user_id)
+    if devices:
+        await asyncio.gather(
+            *[send_event(client, message_type, data) for client in devices],
+            return_exceptions=True
+        )
+
+def queue_batched(websocket, state, message):
+    """Add a message to the connection outbox, merging dialogue updates"""
+    outbox = state['outbox']
+    if message['type'] == 'dialogue_updated':
+        # Only the latest state of a dialogue matters, drop the older update
+        dialogue_id = message['dialogue']['id']
+        previous = state['pending_updates'].get(dialogue_id)
+        if previous is not None:
+            outbox[previous] = None
+        state['pending_updates'][dialogue_id] = len(outbox)
+    outbox.append(message)
+
+    if state['flush_task'] is None:
+        state['flush_task'] = asyncio.create_task(flush_batch(websocket, state))
+
+async def flush_batch(websocket, state):
+    """Send everything gathered during one tick as a single array frame"""
+    await asyncio.sleep(BATCH_TICK_SECONDS)
+    batch = [message for message in state['outbox'] if message is not None]
+    state['outbox'] = []
+    state['pending_updates'] = {}
+    state['flush_task'] = None
+
+    try:
+        await websocket.send(encode_frame(websocket.subprotocol, batch))
+        if sample(log):
+            log.debug("📤 Sent batch", extra=fields(size=len(batch), sample_rate=LOG_SAMPLE_RATE))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
 async def send_message(websocket, message_type, data):
     """Helper to send formatted messages"""
+    frames_out.inc((message_type,))
     message = {'type': message_type, **data}
-    await websocket.send(json.dumps(message))
-    print(f"📤 Sent: {message_type}")
+    state = client_state.get(websocket)
+    if state is not None and state['batch']:
+        queue_batched(websocket, state, message)
+        return
+    await websocket.send(encode_frame(websocket.subprotocol, message))
+    if sample(log):
+        log.debug("📤 Sent %s", message_type, extra=fields(sample_rate=LOG_SAMPLE_RATE))
+
+# Resumable sessions. Every broadcast event, and every event sent to all of a
+# user's devices, gets a monotonic eventSeq and is kept in a bounded replay
+# buffer, so a reconnecting client can ask for just the events it missed.
+# Workers see the same events in the same broker order and therefore number
+# them identically; the epoch changes on every restart. While a resume is
+# being answered, live events for that connection are held and sent after it,
+# so the client sees every eventSeq once and in order.
+SERVER_EPOCH = uuid.uuid4().hex[:12]
+event_seq = 0
+replay_buffer = deque(maxlen=REPLAY_BUFFER_SIZE)  # (message_type, data, user_id), eventSeq order
+
+def record_event(message_type, data, user_id=None):
+    """Stamp an outbound event with the next eventSeq and remember it.
+
+    user_id limits the replay to that user's connections, None is for everyone.
+    """
+    global event_seq
+    event_seq += 1
+    data = {**data, 'eventSeq': event_seq}
+    replay_buffer.append((message_type, data, user_id))
+    return data
+
+def session_info():
+    return {'epoch': SERVER_EPOCH, 'eventSeq': event_seq}
+
+async def send_event(websocket, message_type, data):
+    """Send a recorded event, or hold it while the connection is being resumed"""
+    state = client_state.get(websocket)
+    if state is not None and state['held'] is not None:
+        state['held'].append((message_type, data))
+        return
+    await send_message(websocket, message_type, data)
+
+def replay_view(websocket, message_type, data, user_id):
+    """A recorded event as this client got it live, None if it wasn't sent to it"""
+    state = client_state[websocket]
+    if data['eventSeq'] > state['joined_seq']:
+        return None  # Already delivered on this connection
+    if user_id is not None and user_id != state['user_id']:
+        return None
+    if message_type == 'presence_batch':
+        relevant = [change for change in data['changes'] if presence_visible_to(websocket, change)]
+        return {**data, 'changes': relevant} if relevant else None
+    return data
+
+async def resume_session(websocket, epoch, last_seq):
+    """Replay events after last_seq, or fall back to a full sync"""
+    state = client_state[websocket]
+    if state['held'] is not None:
+        await send_message(websocket, 'error', {'message': 'Resume already in progress'})
+        return
+    state['held'] = []
+    try:
+        first_seq = event_seq - len(replay_buffer) + 1
+        sent_through = event_seq  # Everything held from here on comes after it
+        if epoch == SERVER_EPOCH and isinstance(last_seq, int) and first_seq - 1 <= last_seq <= event_seq:
+            missed = list(itertools.islice(replay_buffer, last_seq - first_seq + 1, None))
+            replayed = 0
+            for message_type, data, user_id in missed:
+                data = replay_view(websocket, message_type, data, user_id)
+                if data is not None:
+                    await send_message(websocket, message_type, data)
+                    replayed += 1
+            await send_message(websocket, 'resumed', {
+                'epoch': SERVER_EPOCH, 'eventSeq': sent_through, 'replayed': replayed,
+            })
+            log.info("⏩ Resumed session", extra=fields(replayed=replayed))
+        else:
+            # Server restarted or the gap is older than the buffer
+            await send_message(websocket, 'initial_dialogues', {
+                'dialogues': dialogues_by_activity(),
+                'dialogueVersion': dialogue_version(),
+                'epoch': SERVER_EPOCH,
+                'eventSeq': sent_through,
+            })
+            await send_message(websocket, 'resync_required', {'epoch': SERVER_EPOCH, 'eventSeq': sent_through})
+            log.info("🔄 Resume not possible, sent full sync")
+    finally:
+        # Events that came in meanwhile, including any that arrive while these go out
+        held = state['held']
+        while held:
+            state['held'] = []
+            for message_type, data in held:
+                await send_message(websocket, message_type, data)
+            held = state['held']
+        state['held'] = None
 
 async def broadcast_to_all(message_type, data):
     """Broadcast message to all connected clients"""
+    data = record_event(message_type, data)
     if connected_clients:
+        started = time.perf_counter()
         await asyncio.gather(
-            *[send_message(client, message_type, data) for client in connected_clients],
+            *[send_event(client, message_type, data) for client in connected_clients],
             return_exceptions=True
         )
+        broadcast_duration.observe(time.perf_counter() - started, (message_type,))
+
+# Multi-process mode. Each dialogue has a single owner process that applies
+# changes to it; the owner publishes the result through the broker and every
+# process (owner included) updates its replica and fans out to its clients.
+# With one process there is no broker and events are delivered in place.
+WORKER_ID = 0
+WORKER_COUNT = 1
+DIRECTORY_WORKER = 0  # Allocates ids for new dialogues
+broker = None
+clients_by_id = {}  # connection id -> websocket, for replies routed back here
+connection_ids = itertools.count(1)
+
+def dialogue_owner(dialogue_id):
+    """Worker owning a dialogue, stable across processes unlike hash()"""
+    return zlib.crc32(str(dialogue_id).encode()) % WORKER_COUNT
+
+def owns_dialogue(dialogue_id):
+    return dialogue_owner(dialogue_id) == WORKER_ID
+
+def command_owner(command):
+    if command['op'] == 'create_dialogue':
+        return DIRECTORY_WORKER
+    if command['op'] == 'presence_delta':
+        return dialogue_owner(command['userId'])
+    return dialogue_owner(command['dialogueId'])
+
+def origin_of(websocket):
+    """Where to send the direct reply to a command issued by this connection"""
+    return {'worker': WORKER_ID, 'client': client_state[websocket]['id']}
+
+async def reply_to_origin(event, message_type, data):
+    """Acknowledge an event to the local connection that caused it, if any"""
+    origin = event.get('origin')
+    if origin is None or origin['worker'] != WORKER_ID:
+        return
+    websocket = clients_by_id.get(origin['client'])
+    if websocket is None:
+        return
+    try:
+        await send_message(websocket, message_type, data)
+    except websockets.exceptions.ConnectionClosed:
+        pass  # The sender left, everybody else still gets the broadcast
+
+async def run_command(command):
+    """Apply a state change on the dialogue's owner, wherever that is"""
+    owner = command_owner(command)
+    if broker is None or owner == WORKER_ID:
+        await apply_command(command)
+    else:
+        await broker.send_to(owner, command)
+
+async def publish(event):
+    """Deliver an event to every process, this one included"""
+    if broker is None:
+        await deliver_event(event)
+    else:
+        await broker.publish(event)
+
+async def apply_command(command):
+    """Change owned state and publish what happened (runs on the owner only)"""
+    op = command['op']
+
+    if op == 'send_message':
+        new_message = store_message(command['dialogueId'], command['text'], command['isMe'])
+        await publish({
+            'kind': 'message_stored',
+            'message': new_message.to_row(),
+            'origin': command.get('origin'),
+            'tempId': command.get('tempId'),
+        })
+
+    elif op == 'mark_read':
+        dialogue_id = command['dialogueId']
+        # Moving the watermark marks every earlier message as read
+        mark_dialogue_read(dialogue_id)
+        await publish({
+            'kind': 'dialogue_read',
+            'dialogueId': dialogue_id,
+            'reader': 'me',
+            'mark': read_marks[dialogue_id]['me'],
+            'userId': command.get('userId'),
+            'origin': command.get('origin'),
+        })
+
+    elif op == 'create_dialogue':
+        new_id = str(len(dialogues) + 1)
+        contact_id = command.get('contactId')
+        new_dialogue = {
+            'id': new_id,
+            'contactName': command['contactName'],
+            'lastMessage': 'New conversation started',
+            'timestamp': datetime.now().isoformat(),
+            'avatarUrl': f'https://i.pravatar.cc/150?img={random.randint(10, 70)}',
+            'isOnline': contact_id in online_users if contact_id is not None else True
+        }
+        if contact_id is not None:
+            new_dialogue['contactId'] = contact_id
+        add_dialogue(new_dialogue)
+        await publish({'kind': 'dialogue_created', 'dialogue': new_dialogue})
+
+    elif op == 'set_online':
+        # Manual override from the console, announced right away
+        await publish({
+            'kind': 'presence',
+            'changes': [{'dialogueId': command['dialogueId'], 'isOnline': command['isOnline']}],
+        })
+
+    elif op == 'presence_delta':
+        # Only the user's presence owner counts their connections across processes
+        user_id = command['userId']
+        was_online = presence_connections[user_id] > 0
+        presence_connections[user_id] += command['delta']
+        if presence_connections[user_id] <= 0:
+            del presence_connections[user_id]
+        if was_online != (user_id in presence_connections):
+            presence_pending[user_id] = time.monotonic()
+
+def add_dialogue(dialogue):
+    dialogues[dialogue['id']] = dialogue
+    if dialogue.get('contactId') is not None:
+        contact_dialogues.setdefault(dialogue['contactId'], set()).add(dialogue['id'])
+    messages.setdefault(dialogue['id'], DialogueHistory(dialogue['id']))
+    init_read_state(dialogue['id'])
+    dialogue_index.update(dialogue['id'], dialogue_activity(dialogue))
+
+async def deliver_event(event):
+    """Update the local replica and fan the event out to local clients"""
+    kind = event['kind']
+
+    if kind == 'message_stored':
+        msg = ChatMessage.from_row(event['message'])
+        dialogue_id = msg.dialogue_id
+        if not owns_dialogue(dialogue_id):
+            apply_message(msg)
+
+        # Send confirmation to sender
+        await reply_to_origin(event, 'message_sent', {
+            'dialogueId': dialogue_id,
+            'messageId': msg.id,
+            'tempId': event['tempId'],
+            'timestamp': msg.timestamp,
+        })
+
+        # Broadcast to all clients as incoming message
+        await broadcast_to_all('new_message', message_to_wire(msg))
+
+        # Update dialogue for all clients
+        if dialogue_id in dialogues:
+            await broadcast_to_all('dialogue_updated', {
+                'dialogue': dialogue_to_wire(dialogues[dialogue_id])
+            })
+
+    elif kind == 'dialogue_read':
+        dialogue_id = event['dialogueId']
+        if not owns_dialogue(dialogue_id):
+            init_read_state(dialogue_id)
+            read_marks[dialogue_id][event['reader']] = event['mark']
+        dialogue_index.touch(dialogue_id)
+
+        # All of the reader's devices learn the dialogue was read
+        if event.get('userId') is not None:
+            # Recorded, so a device that was offline gets it on resume
+            data = record_event('mark_read_success', {'dialogueId': dialogue_id}, event['userId'])
+            await send_to_user(event['userId'], 'mark_read_success', data)
+        else:
+            await reply_to_origin(event, 'mark_read_success', {
+                'dialogueId': dialogue_id
+            })
+
+    elif kind == 'dialogue_created':
+        dialogue = event['dialogue']
+        if WORKER_ID != DIRECTORY_WORKER:
+            add_dialogue(dialogue)
+        await broadcast_to_all('new_dialogue', {'dialogue': dialogue_to_wire(dialogue)})
+
+    elif kind == 'presence':
+        changes = []
+        for change in event['changes']:
+            user_id = change.get('userId')
+            if user_id is not None:
+                if change['isOnline']:
+                    online_users.add(user_id)
+                else:
+                    online_users.discard(user_id)
+                dialogue_ids = contact_dialogues.get(user_id, ())
+            else:
+                dialogue_ids = [change['dialogueId']]
+            for dialogue_id in dialogue_ids:
+                if dialogue_id in dialogues:
+                    dialogues[dialogue_id]['isOnline'] = change['isOnline']
+                    dialogue_index.touch(dialogue_id)
+                    changes.append({'dialogueId': dialogue_id, 'userId': user_id, 'isOnline': change['isOnline']})
+        if changes:
+            await send_presence_batch(changes)
+
+# Presence. Connections report to the user's presence owner, which counts them
+# across processes and publishes changes once per PRESENCE_FLUSH_INTERVAL.
+# Going offline waits PRESENCE_OFFLINE_GRACE so a reconnecting phone doesn't
+# flap, and a change that is undone before the next flush is never sent.
+presence_connections = Counter()  # user_id -> open connections, on the presence owner
+presence_pending = {}  # user_id -> when the connection count last reached or left zero
+online_users = set()  # Users announced online, on every process
+contact_dialogues = {}  # contact user id -> ids of dialogues with that contact
+
+def presence_visible_to(websocket, change):
+    """Whether a client has the changed contact in its dialogue list"""
+    # Every client sees every dialogue here, except its own user as a contact
+    user_id = client_state[websocket]['user_id']
+    return change['userId'] is None or change['userId'] != user_id
+
+async def send_presence_batch(changes):
+    """One presence_batch frame per client, holding only the changes it cares about"""
+    data = record_event('presence_batch', {'changes': changes})
+    started = time.perf_counter()
+    sends = []
+    for client in connected_clients:
+        relevant = [change for change in changes if presence_visible_to(client, change)]
+        if relevant:
+            sends.append(send_event(client, 'presence_batch', {**data, 'changes': relevant}))
+    await asyncio.gather(*sends, return_exceptions=True)
+    broadcast_duration.observe(time.perf_counter() - started, ('presence_batch',))
+
+async def presence_sweep():
+    """Publish the presence changes that survived debouncing"""
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        now = time.monotonic()
+        changes = []
+        for user_id, changed_at in list(presence_pending.items()):
+            online = user_id in presence_connections
+            if online == (user_id in online_users):
+                del presence_pending[user_id]  # Flapped back before anyone was told
+            elif online or now - changed_at >= PRESENCE_OFFLINE_GRACE:
+                del presence_pending[user_id]
+                changes.append({'userId': user_id, 'isOnline': online})
+        if changes:
+            await publish({'kind': 'presence', 'changes': changes})
+
+async def consume_broker():
+    """Apply commands routed to this worker and events published by any worker"""
+    async for frame in broker.frames():
+        try:
+            if frame['op'] == 'publish':
+                await deliver_event(frame['event'])
+            elif frame['op'] == 'send':
+                await apply_command(frame['command'])
+        except Exception:
+            log.exception("❌ Error handling broker frame", extra=fields(op=frame.get('op')))
+
+# Heartbeats. One sweep task pings every connection that has been quiet for a
+# heartbeat interval and evicts the ones that stop answering, instead of
+# keeping a timer per socket. Half-open mobile connections are aborted right
+# away rather than waiting for a close handshake that will never come.
+reaped_connections = Counter()  # reason -> connections evicted for it
+
+def on_pong(websocket, waiter):
+    state = client_state.get(websocket)
+    if state is None or waiter.cancelled() or waiter.exception() is not None:
+        return
+    state['last_seen'] = time.monotonic()
+    state['ping_sent'] = None
+
+def reap(websocket, reason):
+    state = client_state[websocket]
+    if state['reaped'] is not None:
+        return
+    state['reaped'] = reason
+    reaped_connections[reason] += 1
+    connected_clients.discard(websocket)  # Stop paying for broadcasts right away
+    if reason == 'idle_timeout':
+        # Still answering pings, so say goodbye properly
+        asyncio.create_task(websocket.close(1001, 'idle timeout'))
+    else:
+        websocket.transport.abort()
+
+async def heartbeat():
+    """Ping quiet connections and reap dead or idle ones"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        now = time.monotonic()
+        pings = []
+        for websocket in list(connected_clients):
+            state = client_state[websocket]
+            if IDLE_TIMEOUT and now - state['last_frame'] > IDLE_TIMEOUT:
+                reap(websocket, 'idle_timeout')
+            elif state['ping_sent'] is not None:
+                if now - state['ping_sent'] > HEARTBEAT_TIMEOUT:
+                    reap(websocket, 'heartbeat_timeout')
+            elif now - state['last_seen'] >= HEARTBEAT_INTERVAL:
+                state['ping_sent'] = now
+                pings.append(websocket)
+
+        results = await asyncio.gather(*[websocket.ping() for websocket in pings], return_exceptions=True)
+        for websocket, waiter in zip(pings, results):
+            if isinstance(waiter, Exception):
+                if websocket in client_state:
+                    reap(websocket, 'ping_failed')
+            else:
+                waiter.add_done_callback(lambda done, client=websocket: on_pong(client, done))
+
+async def history_retention():
+    """Spill messages that fell out of the hot window by age"""
+    while True:
+        await asyncio.sleep(HISTORY_SWEEP_INTERVAL)
+        now = time.time()
+        spilled = 0
+        for history in list(messages.values()):
+            spilled += await history.trim(now)
+        if spilled:
+            log.info("🗄️  Spilled messages to disk", extra=fields(count=spilled))
+
+# Capture mode (--record) writes every handled frame for replay_traffic.py
+recorder = None
+
+def capture_id(websocket):
+    return f"{WORKER_ID}:{client_state[websocket]['id']}"
+
+async def flush_recorder():
+    while True:
+        await asyncio.sleep(1)
+        recorder.flush()
+
+# Metrics, scraped from /metrics on the chat port
+FRAME_TYPES = {'get_dialogues', 'get_messages', 'send_message', 'search_messages', 'resume',
+               'ping', 'mark_read', 'create_dialogue'}
+frames_in = MetricCounter('chat_frames_in_total', 'Frames received from clients', ('type',))
+frames_out = MetricCounter('chat_frames_out_total', 'Messages sent to clients', ('type',))
+broadcast_duration = Histogram('chat_broadcast_duration_seconds',
+                               'Time to hand one event to every local client', ('type',))
+Gauge('chat_connected_clients', 'Open client connections', function=lambda: len(connected_clients))
+
+async def handle_frame(websocket, data):
+    """Handle one decoded frame from a client"""
+    message_type = data.get('type')
+    # Unknown types share one label so clients can't grow the series without bound
+    frames_in.inc((message_type if isinstance(message_type, str) and message_type in FRAME_TYPES else 'unknown',))
+    if sample(log):
+        log.debug("📥 Received %s", message_type, extra=fields(sample_rate=LOG_SAMPLE_RATE))
+
+    if data.get('dialogueId') is not None:
+        # Numeric ids are accepted, from here on the id is always a string
+        dialogue_id = parse_dialogue_id(data['dialogueId'])
+        if dialogue_id is None:
+            await send_message(websocket, 'error', {'message': 'Invalid dialogueId'})
+            return
+        data = {**data, 'dialogueId': dialogue_id}
+
+    if message_type == 'get_dialogues':
+        if data.get('updatedSince') is not None:
+            # Incremental refresh, a full list if the version came from elsewhere
+            version = parse_dialogue_version(data['updatedSince'])
+            changed = dialogue_index.changed_since(version) if version is not None else None
+            await send_message(websocket, 'dialogues_changed', {
+                'dialogues': dialogues_by_activity(changed),
+                'full': changed is None,
+                'dialogueVersion': dialogue_version(),
+            })
+        elif data.get('limit') is not None:
+            try:
+                limit = int(data['limit'])
+                if not 1 <= limit <= DIALOGUE_PAGE_MAX:
+                    raise ValueError(f"limit must be between 1 and {DIALOGUE_PAGE_MAX}")
+                ids, next_cursor = dialogue_index.page(limit, data.get('cursor'))
+            except (TypeError, ValueError) as e:
+                await send_message(websocket, 'error', {'message': str(e)})
+                return
+            await send_message(websocket, 'dialogues_page', {
+                'dialogues': dialogues_by_activity(ids),
+                'nextCursor': next_cursor,
+                'dialogueVersion': dialogue_version(),
+                **session_info(),
+            })
+        else:
+            await send_message(websocket, 'initial_dialogues', {
+                'dialogues': dialogues_by_activity(),
+                'dialogueVersion': dialogue_version(),
+                **session_info(),
+            })
+
+    elif message_type == 'get_messages':
+        dialogue_id = data.get('dialogueId')
+        try:
+            before_seq = None if data.get('beforeSeq') is None else int(data['beforeSeq'])
+            limit = None if data.get('limit') is None else int(data['limit'])
+            if before_seq is not None and before_seq < 1:
+                raise ValueError("beforeSeq must be at least 1")
+            if limit is not None and limit < 1:
+                raise ValueError("limit must be at least 1")
+        except (TypeError, ValueError) as e:
+            await send_message(websocket, 'error', {'message': str(e)})
+            return
+        if dialogue_id in messages:
+            # Whole history by default, limit/beforeSeq page backwards through it
+            page = await messages[dialogue_id].read(before_seq, limit)
+            await send_message(websocket, 'message_history', {
+                'dialogueId': dialogue_id,
+                'messages': [message_to_wire(m) for m in page],
+                'hasMore': bool(page) and page[0].seq > 1,
+            })
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("📨 Sent history", extra=fields(dialogue=dialogue_id, count=len(page)))
+        else:
+            # Send empty message history for new dialogues
+            await send_message(websocket, 'message_history', {
+                'dialogueId': dialogue_id,
+                'messages': []
+            })
+            log.debug("📭 No messages found", extra=fields(dialogue=dialogue_id))
+
+    elif message_type == 'send_message':
+        dialogue_id = data.get('dialogueId')
+        text = data.get('text', '')
+        temp_id = data.get('tempId')
+
+        if not isinstance(text, str) or not text:
+            await send_message(websocket, 'error', {'message': 'text must be a non-empty string'})
+            return
+        if dialogue_id:
+            # The owner stores it, confirms to us and broadcasts it
+            await run_command({
+                'op': 'send_message',
+                'dialogueId': dialogue_id,
+                'text': text,
+                'isMe': True,
+                'tempId': temp_id,
+                'origin': origin_of(websocket),
+            })
+
+            if sample(log):
+                log.debug("💬 Message sent", extra=fields(dialogue=dialogue_id, length=len(text),
+                                                         sample_rate=LOG_SAMPLE_RATE))
+
+    elif message_type == 'search_messages':
+        query = str(data.get('query', ''))
+        dialogue_id = data.get('dialogueId')  # Search one dialogue, all of them if absent
+        try:
+            limit = int(data.get('limit', 20))
+            if not 1 <= limit <= SEARCH_PAGE_MAX:
+                raise ValueError(f"limit must be between 1 and {SEARCH_PAGE_MAX}")
+            before = data.get('cursor')
+            hits, total, next_cursor = search_index.search(
+                query, dialogue_id, limit, None if before is None else int(before)
+            )
+        except (TypeError, ValueError) as e:
+            await send_message(websocket, 'error', {'message': str(e)})
+            return
+        results = []
+        for hit_dialogue, seq in hits:
+            # Hits carry the whole message, seq lets the client load the context around it
+            msg = (await messages[hit_dialogue].read(seq + 1, 1))[0]
+            results.append(message_to_wire(msg))
+        await send_message(websocket, 'search_results', {
+            'query': query,
+            'dialogueId': dialogue_id,
+            'results': results,
+            'total': total,
+            'nextCursor': next_cursor,
+        })
+        log.debug("🔍 Search matched", extra=fields(terms=len(query.split()), total=total))
+
+    elif message_type == 'resume':
+        await resume_session(websocket, data.get('epoch'), data.get('lastEventSeq'))
+
+    elif message_type == 'ping':
+        await send_message(websocket, 'pong', {})
+
+    elif message_type == 'mark_read':
+        dialogue_id = data.get('dialogueId')
+        if dialogue_id in dialogues:
+            await run_command({
+                'op': 'mark_read',
+                'dialogueId': dialogue_id,
+                'userId': client_state[websocket]['user_id'],
+                'origin': origin_of(websocket),
+            })
+
+    elif message_type == 'create_dialogue':
+        # contactId is a user id or username, it ties the dialogue to that user's presence
+        contact_id = data.get('contactId') if isinstance(data.get('contactId'), str) else None
+        await run_command({
+            'op': 'create_dialogue',
+            'contactName': data.get('contactName', 'New Contact'),
+            'contactId': user_ids_by_username.get(contact_id, contact_id),
+        })
+
+    else:
+        log.warning("❓ Unknown message type", extra=fields(type=str(message_type)[:64]))
+
+async def process_frame(websocket, data, previous, in_flight):
+    """Run one frame, after the previous frame for the same dialogue if any"""
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await handle_frame(websocket, data)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    except Exception as e:
+        log.exception("❌ Error handling message", extra=fields(type=str(data.get('type') if isinstance(data, dict) else None)[:64]))
+        try:
+            await send_message(websocket, 'error', {
+                'message': str(e)
+            })
+        except websockets.exceptions.ConnectionClosed:
+            pass
+    finally:
+        in_flight.release()
 
 async def handle_client(websocket):
     """Handle individual client connection"""
+    params = connection_params(websocket)
+    user_id = handshake_users.pop(websocket, None)  # None for anonymous clients
+    client_state[websocket] = {
+        'id': next(connection_ids),
+        'user_id': user_id,
+        # Opt-in batched mode: events are sent as JSON arrays once per tick
+        'batch': params.get('batch') in ('1', 'true'),
+        'outbox': [],
+        'pending_updates': {},  # dialogue_id -> outbox index of its update
+        'flush_task': None,
+        'last_seen': time.monotonic(),   # Any frame or pong
+        'last_frame': time.monotonic(),  # Application frames only
+        'ping_sent': None,
+        'reaped': None,  # Reason, once the heartbeat evicted the connection
+        'tokens': RATE_LIMIT_BURST,
+        'refilled_at': time.monotonic(),
+        'throttled': False,  # Already told the client it is being throttled
+        'joined_seq': event_seq,  # Later events are delivered live, a resume skips them
+        'held': None,  # Live events waiting while a resume is answered
+    }
+    clients_by_id[client_state[websocket]['id']] = websocket
+    if user_id is not None:
+        user_connections.setdefault(user_id, set()).add(websocket)
     connected_clients.add(websocket)
-    print(f"✅ Client connected. Total clients: {len(connected_clients)}")
+    log.info("✅ Client connected", extra=fields(user=user_id or 'anonymous', clients=len(connected_clients)))
+
+    # Frames are processed concurrently, up to a bound, so a ping or history
+    # fetch isn't stuck behind a broadcast. Frames for the same dialogue are
+    # chained so they still apply in the order the client sent them.
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT_PER_CONNECTION)
+    dialogue_tails = {}  # dialogue_id -> task of the latest frame for it
+    running = set()
+
+    if recorder is not None:
+        recorder.record(capture_id(websocket), 'open', {
+            'userId': user_id,
+            'batch': client_state[websocket]['batch'],
+        })
 
     try:
+        if user_id is not None:
+            await run_command({'op': 'presence_delta', 'userId': user_id, 'delta': 1})
+
         async for message in websocket:
-            try:
-                data = json.loads(message)
-                message_type = data.get('type')
-                print(f"📥 Received: {message_type}")
+            state = client_state[websocket]
+            state['last_seen'] = state['last_frame'] = time.monotonic()
 
-                if message_type == 'get_dialogues':
-                    await send_message(websocket, 'initial_dialogues', {
-                        'dialogues': list(dialogues.values())
-                    })
+            allowed = take_token(state)
+            invalid = False
+            if allowed or recorder is not None:
+                try:
+                    data = decode_frame(message)
+                except FrameDecodeError:
+                    invalid = True
 
-                elif message_type == 'get_messages':
-                    dialogue_id = data.get('dialogueId')
-                    if dialogue_id in messages:
-                        await send_message(websocket, 'message_history', {
-                            'dialogueId': dialogue_id,
-                            'messages': messages[dialogue_id]
-                        })
-                        print(f"📨 Sent {len(messages[dialogue_id])} messages for dialogue {dialogue_id}")
-                    else:
-                        # Send empty message history for new dialogues
-                        await send_message(websocket, 'message_history', {
-                            'dialogueId': dialogue_id,
-                            'messages': []
-                        })
-                        print(f"📭 No messages found for dialogue {dialogue_id}")
-
-                elif message_type == 'send_message':
-                    global message_counter
-                    dialogue_id = data.get('dialogueId')
-                    text = data.get('text', '')
-                    temp_id = data.get('tempId')
-
-                    if dialogue_id and text:
-                        message_counter += 1
-                        new_message_id = f"msg_{dialogue_id}_{message_counter}"
-                        timestamp = datetime.now().isoformat()
-
-                        # Create new message
-                        new_message = {
-                            'id': new_message_id,
-                            'dialogueId': dialogue_id,
-                            'text': text,
-                            'isMe': True,
-                            'timestamp': timestamp,
-                            'isDelivered': True,
-                            'isRead': False,
-                        }
-
-                        # Store message
-                        if dialogue_id not in messages:
-                            messages[dialogue_id] = []
-                        messages[dialogue_id].append(new_message)
-
-                        # Update dialogue last message
-                        if dialogue_id in dialogues:
-                            dialogues[dialogue_id]['lastMessage'] = text
-                            dialogues[dialogue_id]['timestamp'] = timestamp
-
-                        # Send confirmation to sender
-                        await send_message(websocket, 'message_sent', {
-                            'dialogueId': dialogue_id,
-                            'messageId': new_message_id,
-                            'tempId': temp_id,
-                            'timestamp': timestamp,
-                        })
-
-                        # Broadcast to all clients as incoming message
-                        await broadcast_to_all('new_message', new_message)
-
-                        # Update dialogue for all clients
-                        await broadcast_to_all('dialogue_updated', {
-                            'dialogue': dialogues[dialogue_id]
-                        })
-
-                        print(f"💬 Message sent in dialogue {dialogue_id}: {text}")
-
-                elif message_type == 'ping':
-                    await send_message(websocket, 'pong', {})
-
-                elif message_type == 'mark_read':
-                    dialogue_id = data.get('dialogueId')
-                    if dialogue_id in dialogues:
-                        dialogues[dialogue_id]['unreadCount'] = 0
-                        await send_message(websocket, 'mark_read_success', {
-                            'dialogueId': dialogue_id
-                        })
-
-                        # Mark all messages in this dialogue as read
-                        if dialogue_id in messages:
-                            for msg in messages[dialogue_id]:
-                                if not msg['isMe']:
-                                    msg['isRead'] = True
-
-                elif message_type == 'create_dialogue':
-                    contact_name = data.get('contactName', 'New Contact')
-                    new_id = str(len(dialogues) + 1)
-                    new_dialogue = {
-                        'id': new_id,
-                        'contactName': contact_name,
-                        'lastMessage': 'New conversation started',
-                        'timestamp': datetime.now().isoformat(),
-                        'unreadCount': 0,
-                        'avatarUrl': f'https://i.pravatar.cc/150?img={random.randint(10, 70)}',
-                        'isOnline': True
-                    }
-                    dialogues[new_id] = new_dialogue
-                    messages[new_id] = []  # Initialize empty message list
-
-                    await broadcast_to_all('new_dialogue', {'dialogue': new_dialogue})
+            if recorder is not None:
+                # Before acting on it, so a replay sees what the client really sent
+                marker = 'invalid' if invalid else 'throttled' if not allowed else None
+                recorder.record(capture_id(websocket), 'frame', raw_frame(message) if invalid else data, marker)
 
-                else:
-                    print(f"❓ Unknown message type: {message_type}")
+            if not allowed:
+                admission_counters['throttled_frames'] += 1
+                # One error per throttling episode, not one per dropped frame
+                if not state['throttled']:
+                    state['throttled'] = True
+                    await send_message(websocket, 'error', {'message': 'Rate limit exceeded'})
+                continue
+            state['throttled'] = False
 
-            except json.JSONDecodeError:
-                print("⚠️  Invalid JSON received")
-                await send_message(websocket, 'error', {
-                    'message': 'Invalid JSON format'
-                })
-            except Exception as e:
-                print(f"❌ Error handling message: {e}")
-                import traceback
-                traceback.print_exc()
+            if invalid:
+                log.warning("⚠️  Invalid frame received", extra=fields(user=user_id or 'anonymous'))
                 await send_message(websocket, 'error', {
-                    'message': str(e)
+                    'message': 'Invalid JSON format' if isinstance(message, str) else 'Invalid MessagePack format'
                 })
+                continue
+
+            # Stop reading while the connection has too much in flight
+            await in_flight.acquire()
+
+            # Same key for 1 and '1', handle_frame treats them as one dialogue
+            dialogue_id = parse_dialogue_id(data.get('dialogueId')) if isinstance(data, dict) else None
+            previous = dialogue_tails.get(dialogue_id) if dialogue_id is not None else None
+
+            task = asyncio.create_task(process_frame(websocket, data, previous, in_flight))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            if dialogue_id is not None:
+                dialogue_tails[dialogue_id] = task
+                task.add_done_callback(
+                    lambda done, key=dialogue_id: dialogue_tails.pop(key)
+                    if dialogue_tails.get(key) is done else None
+                )
 
     except websockets.exceptions.ConnectionClosed:
-        print("🔌 Client disconnected")
+        log.debug("🔌 Client disconnected")
     finally:
-        connected_clients.remove(websocket)
-        print(f"👋 Client removed. Total clients: {len(connected_clients)}")
+        connected_clients.discard(websocket)
+        # Let accepted frames finish, e.g. a send_message still being stored
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        if recorder is not None:
+            recorder.record(capture_id(websocket), 'close')
+        state = client_state.pop(websocket)
+        del clients_by_id[state['id']]
+        if user_id is not None:
+            devices = user_connections[user_id]
+            devices.discard(websocket)
+            if not devices:
+                del user_connections[user_id]
+            await run_command({'op': 'presence_delta', 'userId': user_id, 'delta': -1})
+        if state['flush_task'] is not None:
+            state['flush_task'].cancel()
+        log.info("👋 Client removed", extra=fields(reason=state['reaped'] or 'closed', clients=len(connected_clients)))
 
 async def handle_console_input():
     """Handle console input for manual message sending"""
@@ -347,6 +1242,8 @@ async def handle_console_input():
     print("msgs <id>       - Show messages for dialogue (e.g., 'msgs 1')")
     print("online <id>     - Set user online (e.g., 'online 1')")
     print("offline <id>    - Set user offline (e.g., 'offline 1')")
+    print("stats           - Show connection statistics")
+    print("profile <s> [f] - Sample the server for s seconds, write collapsed stacks to f")
     print("quit            - Stop server")
     print("=" * 60 + "\n")
 
@@ -354,6 +1251,10 @@ async def handle_console_input():
 
     while True:
         user_input = await loop.run_in_executor(None, sys.stdin.readline)
+        if not user_input:
+            # End of input, e.g. stdin is /dev/null under a benchmark or a service manager
+            print("⌨️  No console input, console commands are off")
+            return
         user_input = user_input.strip()
 
         if not user_input:
@@ -365,12 +1266,52 @@ async def handle_console_input():
                 task.cancel()
             break
 
+        elif user_input.lower() == 'stats':
+            print("\n📊 Connections:")
+            print("-" * 60)
+            print(f"Connected clients: {len(connected_clients)} ({len(user_connections)} users)")
+            reaped = ", ".join(f"{reason}: {count}" for reason, count in reaped_connections.items())
+            print(f"Reaped: {sum(reaped_connections.values())} ({reaped or 'none'})")
+            print(f"Rejected at handshake: {admission_counters['rejected_full']} full, "
+                  f"{admission_counters['rejected_auth']} unauthenticated")
+            print(f"Throttled frames: {admission_counters['throttled_frames']}")
+            lag = loop_monitor.monitor.stats()
+            print(f"Loop lag: p50 {lag['p50_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms, "
+                  f"max {lag['max_ms']:.1f} ms, {lag['stalls']} stalls")
+            for stall in lag['recent_stalls'][-3:]:
+                print(f"\n🐢 {stall['at']} blocked {stall['lag_ms']:.0f} ms in:")
+                print(stall['stack'].rstrip())
+            print("-" * 60 + "\n")
+
+        elif user_input.lower().startswith('profile'):
+            parts = user_input.split()
+            try:
+                seconds = float(parts[1]) if len(parts) > 1 else 10.0
+            except ValueError:
+                print("⚠️  Usage: profile <seconds> [file]")
+                continue
+            path = parts[2] if len(parts) > 2 else f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed"
+            print(f"🔬 Profiling for {seconds:g}s...")
+            try:
+                stacks = await profile(seconds)
+            except ProfilerBusy as e:
+                print(f"❌ {e}")
+                continue
+            with open(path, 'w') as f:
+                f.write(render_collapsed(stacks))
+            print(f"\n🔬 {sum(stacks.values())} samples written to {path} (flamegraph.pl or speedscope)")
+            print("-" * 60)
+            for name, count, share in top_functions(stacks):
+                print(f"{share:>6.1%} {count:>6}  {name}")
+            print("-" * 60 + "\n")
+
         elif user_input.lower() == 'list':
             print("\n📋 Current Dialogues:")
             print("-" * 60)
             for dialogue in dialogues.values():
                 status = "🟢" if dialogue['isOnline'] else "⚫"
-                unread = f"({dialogue['unreadCount']} unread)" if dialogue['unreadCount'] > 0 else ""
+                unread_total = unread_count(dialogue['id'])
+                unread = f"({unread_total} unread)" if unread_total > 0 else ""
                 msg_count = len(messages.get(dialogue['id'], []))
                 print(f"{status} ID: {dialogue['id']} | {dialogue['contactName']} {unread} | {msg_count} messages")
                 print(f"   Last: {dialogue['lastMessage']}")
@@ -382,10 +1323,10 @@ async def handle_console_input():
                 if dialogue_id in messages:
                     print(f"\n💬 Messages for dialogue {dialogue_id} ({dialogues[dialogue_id]['contactName']}):")
                     print("-" * 60)
-                    for msg in messages[dialogue_id]:
-                        sender = "You" if msg['isMe'] else dialogues[dialogue_id]['contactName']
-                        status = "✓✓" if msg['isRead'] else "✓" if msg['isDelivered'] else "○"
-                        print(f"[{msg['timestamp'][:19]}] {sender}: {msg['text']} {status}")
+                    for msg in await messages[dialogue_id].read():
+                        sender = "You" if msg.is_me else dialogues[dialogue_id]['contactName']
+                        status = "✓✓" if is_message_read(msg) else "✓"
+                        print(f"[{msg.timestamp[:19]}] {sender}: {msg.text} {status}")
                     print("-" * 60 + "\n")
                 else:
                     print(f"❌ No messages found for dialogue ID '{dialogue_id}'")
@@ -396,8 +1337,7 @@ async def handle_console_input():
             try:
                 dialogue_id = user_input.split()[1]
                 if dialogue_id in dialogues:
-                    dialogues[dialogue_id]['isOnline'] = True
-                    await broadcast_to_all('user_online', {'dialogueId': dialogue_id})
+                    await run_command({'op': 'set_online', 'dialogueId': dialogue_id, 'isOnline': True})
                     print(f"✅ {dialogues[dialogue_id]['contactName']} is now ONLINE")
                 else:
                     print(f"❌ Dialogue ID '{dialogue_id}' not found")
@@ -408,8 +1348,7 @@ async def handle_console_input():
             try:
                 dialogue_id = user_input.split()[1]
                 if dialogue_id in dialogues:
-                    dialogues[dialogue_id]['isOnline'] = False
-                    await broadcast_to_all('user_offline', {'dialogueId': dialogue_id})
+                    await run_command({'op': 'set_online', 'dialogueId': dialogue_id, 'isOnline': False})
                     print(f"✅ {dialogues[dialogue_id]['contactName']} is now OFFLINE")
                 else:
                     print(f"❌ Dialogue ID '{dialogue_id}' not found")
@@ -423,35 +1362,12 @@ async def handle_console_input():
                 dialogue_id, message_text = parts
 
                 if dialogue_id in dialogues:
-                    global message_counter
-                    message_counter += 1
-                    timestamp = datetime.now().isoformat()
-                    new_message_id = f"msg_{dialogue_id}_{message_counter}"
-
-                    # Create and store message
-                    new_message = {
-                        'id': new_message_id,
+                    # Store and broadcast, unread count follows from the message
+                    await run_command({
+                        'op': 'send_message',
                         'dialogueId': dialogue_id,
                         'text': message_text,
                         'isMe': False,
-                        'timestamp': timestamp,
-                        'isDelivered': True,
-                        'isRead': False,
-                    }
-
-                    if dialogue_id not in messages:
-                        messages[dialogue_id] = []
-                    messages[dialogue_id].append(new_message)
-
-                    # Update dialogue
-                    dialogues[dialogue_id]['lastMessage'] = message_text
-                    dialogues[dialogue_id]['timestamp'] = timestamp
-                    dialogues[dialogue_id]['unreadCount'] += 1
-
-                    # Broadcast to all clients
-                    await broadcast_to_all('new_message', new_message)
-                    await broadcast_to_all('dialogue_updated', {
-                        'dialogue': dialogues[dialogue_id]
                     })
 
                     print(f"✅ Sent to {dialogues[dialogue_id]['contactName']}: {message_text}")
@@ -478,55 +1394,133 @@ async def simulate_activity():
             "⏰ Auto-message: Don't forget our meeting!",
         ]
 
-        global message_counter
-        message_counter += 1
-        timestamp = datetime.now().isoformat()
-        new_message_id = f"msg_{dialogue_id}_{message_counter}"
-
-        new_message = {
-            'id': new_message_id,
+        await run_command({
+            'op': 'send_message',
             'dialogueId': dialogue_id,
             'text': random.choice(messages_list),
             'isMe': False,
-            'timestamp': timestamp,
-            'isDelivered': True,
-            'isRead': False,
-        }
-
-        if dialogue_id not in messages:
-            messages[dialogue_id] = []
-        messages[dialogue_id].append(new_message)
+        })
 
-        dialogues[dialogue_id]['lastMessage'] = new_message['text']
-        dialogues[dialogue_id]['timestamp'] = timestamp
-        dialogues[dialogue_id]['unreadCount'] += 1
+def serve_options():
+    """Keyword arguments shared by every websockets.serve call"""
+    return {
+        'subprotocols': SUBPROTOCOLS,
+        'select_subprotocol': select_subprotocol,
+        'compression': None,  # Configured through the extension below
+        'extensions': compression_extensions(),
+        'process_request': process_request,
+        'ping_interval': None,  # heartbeat() pings instead of a timer per connection
+    }
 
-        await broadcast_to_all('new_message', new_message)
-        await broadcast_to_all('dialogue_updated', {
-            'dialogue': dialogues[dialogue_id]
-        })
+def start_recording(path):
+    global recorder
+    recorder = TrafficRecorder(path)
+    asyncio.create_task(flush_recorder())
+    print(f"⏺️  Recording inbound frames to {path}")
 
-async def main():
+async def main(port=8080, record=None):
     """Start WebSocket server"""
     print("\n" + "=" * 60)
     print("🚀 WebSocket Chat Server Starting...")
     print("=" * 60)
 
-    server = await websockets.serve(handle_client, "0.0.0.0", 8080)
+    server = await websockets.serve(handle_client, "0.0.0.0", port, **serve_options())
 
-    print("✅ Server: ws://localhost:8080")
-    print("📱 Android Emulator: ws://10.0.2.2:8080")
-    print("🌐 Local Network: ws://<your-ip>:8080")
+    print(f"✅ Server: ws://localhost:{port}")
+    print(f"📱 Android Emulator: ws://10.0.2.2:{port}")
+    print(f"🌐 Local Network: ws://<your-ip>:{port}")
+    if record:
+        start_recording(record)
 
     asyncio.create_task(handle_console_input())
+    loop_monitor.start_monitor()
+    asyncio.create_task(heartbeat())
+    asyncio.create_task(history_retention())
+    asyncio.create_task(presence_sweep())
 
     # Uncomment to enable auto-messages
     # asyncio.create_task(simulate_activity())
 
     await asyncio.Future()
 
+async def worker_main(worker_id, worker_count, port, record=None):
+    """One of N processes sharing the port through SO_REUSEPORT"""
+    global WORKER_ID, WORKER_COUNT, broker
+    WORKER_ID, WORKER_COUNT = worker_id, worker_count
+    broker = await BrokerClient.connect(BROKER_SOCKET_PATH, worker_id)
+
+    await websockets.serve(handle_client, "0.0.0.0", port, reuse_port=True, **serve_options())
+    print(f"✅ Worker {worker_id} listening on ws://localhost:{port}")
+    if record:
+        start_recording(worker_capture_path(record, worker_id))
+    loop_monitor.start_monitor()
+    asyncio.create_task(heartbeat())
+    asyncio.create_task(history_retention())
+    asyncio.create_task(presence_sweep())
+
+    await consume_broker()
+    log.error("🛑 Worker lost the broker, exiting", extra=fields(worker=worker_id))
+
+def run_worker(worker_id, worker_count, port, record=None, log_level=None):
+    setup_logging(log_level)  # The parent's writer thread didn't survive the fork
+    try:
+        asyncio.run(worker_main(worker_id, worker_count, port, record))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()  # Worker processes skip atexit
+
+def run_cluster(worker_count, port, record=None, log_level=None):
+    """Run the broker here and fork the workers (Linux, SO_REUSEPORT)"""
+    print("\n" + "=" * 60)
+    print(f"🚀 WebSocket Chat Server Starting with {worker_count} workers...")
+    print("=" * 60)
+
+    # Fork before any event loop exists so workers start from the same mock data
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=run_worker, args=(worker_id, worker_count, port, record, log_level), daemon=True)
+        for worker_id in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    setup_logging(log_level)
+
+    try:
+        asyncio.run(run_broker(BROKER_SOCKET_PATH))
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+            remove_spill_files(worker.pid)  # Terminated workers don't clean up themselves
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebSocket chat server")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of server processes sharing the port (console only with 1)")
+    parser.add_argument('--record', metavar='PATH',
+                        help="capture inbound frames for replay_traffic.py (one file per worker)")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper,
+                        help=f"overrides LOG_LEVEL ({LOG_LEVEL})")
+    parser.add_argument('--rate-limit', type=float, metavar='FPS',
+                        help=f"frames per second per connection, 0 turns the limit off "
+                             f"({RATE_LIMIT_FRAMES_PER_SECOND}), e.g. for fast replay_traffic.py runs")
+    args = parser.parse_args()
+    if args.rate_limit is not None:
+        RATE_LIMIT_BURST = 2 * args.rate_limit  # Two seconds' worth, like the default
+        RATE_LIMIT_FRAMES_PER_SECOND = args.rate_limit
+
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            run_cluster(args.workers, args.port, args.record, args.log_level)
+        else:
+            setup_logging(args.log_level)
+            asyncio.run(main(args.port, args.record))
     except KeyboardInterrupt:
-        print("\n👋 Server stopped by user")
\ No newline at end of file
+        print("\n👋 Server stopped by user")
+    finally:
+        if recorder is not None:
+            recorder.close()
+        remove_spill_files()
@@ -0,0 +1,75 @@
+# traffic_capture.py
+# Record inbound chat traffic to a file that replay_traffic.py can play back.
+#
+# A capture is gzip-compressed JSON lines, one event per line:
+#   [time, connection, 'open', {'userId': ..., 'batch': false}]
+#   [time, connection, 'frame', {...decoded frame...}]
+#   [time, connection, 'frame', {...decoded frame...}, 'throttled']
+#   [time, connection, 'frame', {'text': ...} or {'binary': base64}, 'invalid']
+#   [time, connection, 'close', null]
+# time is epoch seconds, so captures from several workers can be merged.
+# Frames are recorded as they arrive, before the rate limiter: 'throttled'
+# ones were dropped by it, 'invalid' ones didn't decode and are kept raw.
+import base64
+import gzip
+import json
+import os
+import time
+
+
+class TrafficRecorder:
+    """Appends capture events to a gzip file, flushed so a killed server loses little"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt', compresslevel=6)
+        self.events = 0
+
+    def record(self, connection, kind, payload=None, marker=None):
+        event = [time.time(), connection, kind, payload]
+        if marker is not None:
+            event.append(marker)
+        self.file.write(json.dumps(event, separators=(',', ':')))
+        self.file.write('\n')
+        self.events += 1
+
+    def flush(self):
+        # Makes everything so far readable even if the trailer is never written
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def raw_frame(message):
+    """Payload of a frame that didn't decode, as it was sent"""
+    if isinstance(message, bytes):
+        return {'binary': base64.b64encode(message).decode('ascii')}
+    return {'text': message}
+
+
+def frame_from_raw(payload):
+    """The str or bytes raw_frame() was given"""
+    if 'binary' in payload:
+        return base64.b64decode(payload['binary'])
+    return payload['text']
+
+
+def worker_capture_path(path, worker_id):
+    """traffic.jsonl.gz -> traffic.jsonl.worker2.gz, one capture per process"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{worker_id}{ext}"
+
+
+def read_capture(paths):
+    """Events of one or more captures, merged in time order"""
+    events = []
+    for path in paths:
+        with gzip.open(path, 'rt') as f:
+            try:
+                for line in f:
+                    events.append(json.loads(line))
+            except (EOFError, json.JSONDecodeError):
+                pass  # Recorder was killed mid-write, keep what was flushed
+    events.sort(key=lambda event: event[0])
+    return events